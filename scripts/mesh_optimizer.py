@@ -1,17 +1,28 @@
-from collections import deque
+import argparse
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+import glob
+import hashlib
+import heapq
+import itertools
+import json
 import math
+import os
+import re
+import struct
 import sys
+import time
 
-import numpy as np
-from scipy.spatial import ConvexHull
-import shapely
-from shapely.ops import triangulate
+# numpy, scipy and shapely take most of the startup time and only some paths need them,
+# so they are imported where they are used.
 
+# Expression over the vertex fields x, y, z, u, v, r, g, b, a evaluated on whole arrays, vertices it is true for are dropped
+# together with triangles made of only dropped vertices, see VtxFilter
 VTX_FILTER = None
 VTX_SUFFIX = 'opt'
 
 # CCCoral
-#VTX_FILTER = lambda vtx: vtx.pos.y < 373
+#VTX_FILTER = 'y < 373'
 #VTX_SUFFIX = 'opt_p'
 
 HAS_EX3_COMMANDS = True
@@ -19,11 +30,155 @@ HAS_TRI3 = False
 #VTX_BUF_SIZE = 56
 VTX_BUF_SIZE = 59
 
+# Strip builder: 'greedy' walks the strip with a bounded lookahead, 'dfs' is the exhaustive search
+STRIP_ALGO = 'greedy'
+# How many triangles ahead the greedy strip builder looks when picking the next triangle
+STRIP_LOOKAHEAD = 4
+
 # Current DFS implementation is O(2^n) algo so not to wait forever we limit the amount of triangles to walk through
 WALK_LIMIT = 10000
 
+# Vertex loader for chunks that do not fit the vertex buffer: 'greedy' loads the most used vertex first,
+# 'partition' grows buffer sized clusters of triangles keeping the vertices shared with the next cluster low
+VTX_LOADER = 'greedy'
+
+# Reorder triangles of chunks that do not fit the vertex buffer for locality before loading vertices
+TRI_REORDER = False
+
+# Prefix display lists with gsSPCullDisplayList so the RSP skips them when they are off screen:
+# 'off', 'aabb' loads the corners of the bounding box, 'auto' uses the convex hull when it is small enough.
+# gsSPCullDisplayList ends the whole display list so the prefix goes in front of the list covering all of its chunks.
+# A list made of a single chunk followed by nothing but the list end is culled by the chunk itself instead,
+# so hull vertices can be pinned to its first render pass at no extra cost.
+CULL_MODE = 'off'
+# Bounding box costs up to 8 extra vertices so a hull with more vertices is not worth it
+CULL_HULL_MAX_VERTICES = 8
+# Smaller chunks are cheaper to draw than to test
+CULL_MIN_TRIANGLES = 32
+# Meshes spanning most of the level are on screen from anywhere in it
+CULL_MAX_EXTENT = 8192
+
+# Keep vertices loaded by a chunk in the buffer for the next chunk of the list when only RDP commands are between them
+SHARE_VTX_BUFFER = False
+
+# Split display lists that could be culled into up to this many sub-lists over a BVH of triangle centroids, 1 is off.
+# Every sub-list replays the state commands its chunks need, draws the triangles of its cell and is culled on its own,
+# the list itself calls them and keeps what follows its last chunk.
+SPLIT_COUNT = 1
+# Cells with fewer triangles are not split further
+SPLIT_MIN_TRIANGLES = 256
+# Cut positions tried along each axis, at quantiles of the centroids
+SPLIT_CANDIDATES = 16
+# Cuts are priced by the surface area heuristic, triangles of each side weighted by how much of the cell its bounds cover,
+# plus this many triangles for every vertex the cut duplicates
+SPLIT_DUP_COST = 0.5
+# ...and this many triangles for every state command replayed by both sides, counted in front of the chunks they share
+SPLIT_STATE_COST = 0.25
+
+# Merge vertices of a chunk closer than this in every coordinate before compiling it, None is off
+WELD_POS_TOLERANCE = None
+# ...if their UV and color are this close as well
+WELD_UV_TOLERANCE = 1
+WELD_COLOR_TOLERANCE = 1
+
+# Merge adjacent triangles lying within this distance of the same plane into polygons and triangulate them again
+# without the vertices inside them, None is off
+RETRI_TOLERANCE = None
+# How far UV and color of a removed vertex can be from what the new triangles interpolate at its position
+RETRI_ATTR_TOLERANCE = 2
+
+# Echo every display list line and the debug logs, off by default because it is slow on big models
+VERBOSE = False
+
 def log_debug(line):
-    pass
+    if VERBOSE:
+        print(line)
+
+class Profiler:
+    # Phase timers are exclusive - entering a nested phase pauses the outer one so the phases add up to the total
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.timings = {}
+        self.counters = {}
+        self.meshes = []
+        self._stack = []
+        self._started = None
+
+    def _account(self):
+        now = time.perf_counter()
+        if self._stack:
+            name = self._stack[-1]
+            self.timings[name] = self.timings.get(name, 0.0) + now - self._started
+        self._started = now
+
+    def push(self, name):
+        self._account()
+        self._stack.append(name)
+
+    def pop(self):
+        self._account()
+        self._stack.pop()
+
+    def switch(self, name):
+        self._account()
+        self._stack[-1] = name
+
+    @contextmanager
+    def phase(self, name):
+        self.push(name)
+        try:
+            yield
+        finally:
+            self.pop()
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def mesh(self, name, **values):
+        self.meshes.append({ 'name': name, **values })
+
+    def snapshot(self):
+        return { 'timings': dict(self.timings), 'counters': dict(self.counters), 'meshes': list(self.meshes) }
+
+    def merge(self, snapshot):
+        # Used for results coming from worker processes - their timings add up to CPU time rather than wall time
+        for name, value in snapshot['timings'].items():
+            self.timings[name] = self.timings.get(name, 0.0) + value
+        for name, value in snapshot['counters'].items():
+            self.count(name, value)
+        self.meshes.extend(snapshot.get('meshes', []))
+
+    def format(self):
+        lines = []
+        for name, value in sorted(self.timings.items(), key=lambda item: -item[1]):
+            lines.append(f"{name.ljust(20)} {value:8.3f}s")
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"{name.ljust(20)} {value:9}")
+        return '\n'.join(lines)
+
+PROFILER = Profiler()
+
+# {{{ x, y, z }, flag, { u, v }, { r, g, b, a }}} with decimal or hex C integer literals
+VTX_INT = r'(-?(?:0[xX][0-9a-fA-F]+|\d+))'
+VTX_RE = re.compile(r'\{\{\{\s*' + r',\s*'.join([ VTX_INT ] * 3) + r'\s*\},\s*' + VTX_INT + r',\s*\{\s*' + r',\s*'.join([ VTX_INT ] * 2) + r'\s*\},\s*\{\s*' + r',\s*'.join([ VTX_INT ] * 4) + r'\s*\}\}\}')
+# Each vertex is kept as a fixed-size record: pos s16 x3, flag u16, uv s16 x2, color/normal s16 x4.
+# Colors are unsigned bytes and normals signed bytes so s16 holds either.
+VTX_STRUCT = struct.Struct('<3hH2h4h')
+
+def format_vtx(values):
+    x, y, z, flag, u, v, r, g, b, a = values
+    return f"{{{{{{ {x}, {y}, {z} }}, {flag}, {{ {u}, {v} }}, {{ {r}, {g}, {b}, {a}}}}}}},\n"
+
+# The only commands the optimizer needs to understand inside of the display lists
+DRAW_RE = re.compile(r'\s*(gsSPVertex|gsSP1Triangle|gsSP2Triangles)\(([^()]*)\)')
+
+def parse_draw(line):
+    match = DRAW_RE.match(line)
+    if not match:
+        return None
+    return match.group(1), [ arg.strip() for arg in match.group(2).split(',') ]
 
 def get_args(line):
     bracket_open = line.find('(')
@@ -46,6 +201,9 @@ class ModelRawEntry(ModelEntry):
     def add(self, line):
         self.data.append(line)
 
+    def extend(self, lines):
+        self.data.extend(lines)
+
     def __repr__(self):
         return f"ModelRawEntry(name={self.name})"
 
@@ -65,127 +223,165 @@ class ModelRawOptEntry(ModelEntry):
 class ModelVtxEntry(ModelEntry):
     def __init__(self, line):
         super().__init__(line)
-        self.vertices = []
+        # Source text until the vertices are first needed, VTX_STRUCT records back to back after that
+        self._records = None
+        self._lines = []
         self.used = False
-    
-    def add(self, vertex):
-        self.vertices.append(vertex)
+
+    def extend(self, lines):
+        self._lines.extend(lines)
+
+    @property
+    def records(self):
+        if self._records is None:
+            self.pack()
+        return self._records
+
+    @records.setter
+    def records(self, records):
+        self._records = records
+        self._lines = None
+
+    def pack(self):
+        # Parse every vertex once and drop the source text
+        text = ''.join(self._lines)
+        if not self._lines or not self._lines[-1].startswith('};'):
+            raise ValueError(f"unexpected end of Vtx array {self.name}")
+        values = VTX_RE.findall(text)
+        if len(values) != text.count('{{{'):
+            raise ValueError(f"unexpected vertex format in {self.name}, only integer literals are supported")
+        self.records = b''.join([ VTX_STRUCT.pack(*[ int(value, 0) for value in vtx ]) for vtx in values ])
+
+    def __len__(self):
+        return len(self.records) // VTX_STRUCT.size
+
+    def record(self, idx):
+        return self.records[idx * VTX_STRUCT.size:(idx + 1) * VTX_STRUCT.size]
+
+    def lines(self):
+        # Arrays nothing looked into are written back as they were read
+        if self._records is None:
+            yield from self._lines
+            return
+        for values in VTX_STRUCT.iter_unpack(self._records):
+            yield format_vtx(values)
+        yield '};\n'
 
     def __repr__(self):
         return f"ModelVtxEntry(name={self.name})"
 
-class UsagePricer:
-    def __init__(self, req_tris, loaded_vertices=None, rendered_tris=[], banned_vertices=None):
-        self._vertices_to_triangle = {}
-        self._usage_to_vertices = {}
-        self._banned_vertices = set(banned_vertices) if banned_vertices else set()
-        self._loaded_vertices = loaded_vertices if loaded_vertices else []
+class TriTable:
+    # Triangles of a mesh addressed by their id. Vertex and edge to triangle lookups are built once per mesh,
+    # the users keep their own 'alive' masks over the ids so removing a triangle is O(1).
+    def __init__(self, triangles):
+        self.rows = [ tuple(tri) for tri in triangles ]
 
+        # Triangle ids of every vertex in increasing order
+        self.vtx_tris = {}
+        self.edge_tris = {}
+        for i, tri in enumerate(self.rows):
+            for vtx in tri:
+                self.vtx_tris.setdefault(vtx, []).append(i)
+            for edge in TriKit._edges(tri):
+                self.edge_tris.setdefault(edge, []).append(i)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def mask(self):
+        return bytearray(len(self.rows))
+
+class UsagePricer:
+    # Keeps the usage of every not yet loaded vertex up to date as triangles are added, removed or rendered and
+    # vertices are loaded. The highest usage is served from a heap with lazy deletion - stale entries are skipped
+    # when they reach the top. Ties go to the vertex the pricer got first.
+    # Triangles are ids in 'table', the ones the pricer holds are marked in its own 'alive' mask.
+    def __init__(self, table, req_tris=(), loaded_vertices=None, rendered_tris=()):
+        PROFILER.count('pricers')
+        self._table = table
+        self._alive = table.mask()
+        self._tri_costs = [ 0 ] * len(table)
+        self._usage = {}
+        # Order in which vertices got a usage, the tie breaker of the heap
+        self._seq = {}
+        self._heap = []
+        self._loaded_vertices = loaded_vertices if loaded_vertices is not None else {}
+
+        # 'rendered_tris' are in buffer indices rather than ids
         self._inverse_edges = set()
         for tri in rendered_tris:
             for edge in TriKit._edges_reverse(tri):
                 self._inverse_edges.add(edge)
 
         for tri in req_tris:
-            for vtx in tri:
-                if vtx in self._banned_vertices:
-                    continue
-
-                if vtx not in self._vertices_to_triangle:
-                    self._vertices_to_triangle[vtx] = set()
-                self._vertices_to_triangle[vtx].add(tri)
-
-        for vtx, tris in self._vertices_to_triangle.items():
-            usage = self._tris_cost(tris)
-            if usage not in self._usage_to_vertices:
-                self._usage_to_vertices[usage] = set()
-            self._usage_to_vertices[usage].add(vtx)
+            self.add(tri)
 
     def vtx_to_tris(self, vtx):
-        return self._vertices_to_triangle[vtx]
+        return [ tri for tri in self._table.vtx_tris[vtx] if self._alive[tri] ]
 
-    def vtx_to_tris_optional(self, vtx):
-        return self._vertices_to_triangle.get(vtx)
+    def _rescale(self, vtx, delta):
+        usage = self._usage.get(vtx, 0) + delta
+        if usage:
+            self._usage[vtx] = usage
+            heapq.heappush(self._heap, (-usage, self._seq.setdefault(vtx, len(self._seq)), vtx))
+        else:
+            del self._usage[vtx]
 
     def add(self, tri):
         # Add vtx for the given triangle and rescale the usage
-        assert False, "need rework"
-        for vtx in tri:
-            if vtx in self._banned_vertices:
-                continue
-
-            if vtx not in self._vertices_to_triangle:
-                self._vertices_to_triangle[vtx] = set()
-
-            old_usage = self._tris_cost(self._vertices_to_triangle[vtx])
-            self._vertices_to_triangle[vtx].add(tri)
-            new_usage = self._tris_cost(self._vertices_to_triangle[vtx])
-
-            assert new_usage
-            assert old_usage != new_usage
-
-            if new_usage not in self._usage_to_vertices:
-                self._usage_to_vertices[new_usage] = set()
-            self._usage_to_vertices[new_usage].add(vtx)
+        if self._alive[tri]:
+            return
 
-            if old_usage in self._usage_to_vertices:
-                self._usage_to_vertices[old_usage].remove(vtx)
-                if not self._usage_to_vertices[old_usage]:
-                    del self._usage_to_vertices[old_usage]
+        cost = self._tri_cost(tri)
+        self._alive[tri] = True
+        self._tri_costs[tri] = cost
+        for vtx in self._table.rows[tri]:
+            if vtx not in self._loaded_vertices:
+                self._rescale(vtx, cost)
 
     def remove(self, tri):
         # Remove vtx for the given triangle and rescale the usage
-        for vtx in tri:
-            if vtx in self._banned_vertices:
-                continue
-            if not self._banned_vertices:
-                assert vtx in self._vertices_to_triangle
-            else:
-                if vtx not in self._vertices_to_triangle:
-                    continue
-
-            old_usage = self._tris_cost(self._vertices_to_triangle[vtx])
-            self._vertices_to_triangle[vtx].remove(tri)
-            if not self._vertices_to_triangle[vtx]:
-                del self._vertices_to_triangle[vtx]
-                new_usage = 0
-            else:
-                new_usage = self._tris_cost(self._vertices_to_triangle[vtx])
-
-            assert old_usage != new_usage
-
-            if new_usage != 0:
-                if new_usage not in self._usage_to_vertices:
-                    self._usage_to_vertices[new_usage] = set()
-                self._usage_to_vertices[new_usage].add(vtx)
-
-            self._usage_to_vertices[old_usage].remove(vtx)
-            if not self._usage_to_vertices[old_usage]:
-                del self._usage_to_vertices[old_usage]
-
-    def ban(self, vtx):
-        # Admittedly this is a pretty simplistic approach but it is so simple that it should be fine as is
-        assert False, "need rework"
-        affected_triangles = []
-        if vtx in self._vertices_to_triangle:
-            affected_triangles = list(self._vertices_to_triangle[vtx])
-
-        for tri in affected_triangles:
-            self.remove(tri)
-
-        self._banned_vertices.add(vtx)
+        cost = self._tri_costs[tri]
+        self._alive[tri] = False
+        for vtx in self._table.rows[tri]:
+            if vtx not in self._loaded_vertices:
+                self._rescale(vtx, -cost)
+
+    def _rescore(self, tri):
+        old_cost = self._tri_costs[tri]
+        new_cost = self._tri_cost(tri)
+        if old_cost == new_cost:
+            return
 
-        for tri in affected_triangles:
-            # If all vertices are banned then we can skip this triangle
-            if all(vtx in self._banned_vertices for vtx in tri):
+        self._tri_costs[tri] = new_cost
+        for vtx in self._table.rows[tri]:
+            if vtx not in self._loaded_vertices:
+                self._rescale(vtx, new_cost - old_cost)
+
+    def load(self, vtx):
+        # Must be called after 'vtx' was put in 'loaded_vertices' - it is no longer a candidate and
+        # all triangles using it become cheaper to load.
+        self._usage.pop(vtx, None)
+        for tri in self._table.vtx_tris.get(vtx, ()):
+            if self._alive[tri]:
+                self._rescore(tri)
+
+    def render(self, tri):
+        # 'tri' is in buffer indices so its edges are matched as is
+        for edge in TriKit._edges_reverse(tri):
+            if edge in self._inverse_edges:
                 continue
 
-            self.add(tri)
+            self._inverse_edges.add(edge)
+            for ntri in self._table.edge_tris.get(edge, ()):
+                if self._alive[ntri]:
+                    self._rescore(ntri)
 
     def _vtx_cost(self, vtx):
         return 100 if vtx in self._loaded_vertices else 1
 
     def _tri_cost(self, tri):
+        tri = self._table.rows[tri]
         cost = sum([self._vtx_cost(vtx) for vtx in tri])
         for edge in TriKit._edges(tri):
             if edge in self._inverse_edges:
@@ -193,24 +389,18 @@ class UsagePricer:
 
         return cost
 
-    def _tris_cost(self, tris):
-        return sum([self._tri_cost(tri) for tri in tris])
-
-    @staticmethod
-    def any(s):
-        for val in s:
-            break
-        return val
-
     def highest_usage(self):
-        highest_usage = max(self._usage_to_vertices.items())
-        return self.any(highest_usage[1])
+        while True:
+            usage, _, vtx = self._heap[0]
+            if self._usage.get(vtx) == -usage:
+                return vtx
+            heapq.heappop(self._heap)
 
     def completed(self):
-        return not self._usage_to_vertices
+        return not self._usage
 
     def vtx_left(self):
-        return len(self._vertices_to_triangle)
+        return len(self._usage)
 
 class RenderPass:
     def __init__(self, vertices, triangles, snakes):
@@ -253,9 +443,130 @@ class Snake:
                 next_commands = commands[i:end] + [SnakeCommand()] * (8 - (end - i))
                 yield f"\tgsSPContinueSnake({', '.join(map(str, next_commands))}),\n"
 
+    def triangles(self):
+        # Triangles in the order the RSP draws them, see gSPTriSnake in gbi-ex3b.h for the algorithm
+        i1, i2, i3 = self.vertices[:3]
+        a, b, c = i3, i1, i2
+        tris = [ (a, b, c) ]
+        for vtx, turn in zip(self.vertices[3:], self.turns):
+            # Turns are stored by their macro names
+            if 'G_SNAKE_LEFT' == turn:
+                c = a
+            else:
+                b = a
+            a = vtx
+            tris.append((a, b, c))
+        return tris
+
+    def trim(self, count):
+        # Drop 'count' triangles from the tail, returns them as regular triangles
+        tris = self.triangles()[len(self.turns) + 1 - count:]
+        del self.vertices[len(self.vertices) - count:]
+        del self.turns[len(self.turns) - count:]
+        return tris
+
     def __repr__(self):
         return f"Snake({self.vertices} + {self.turns})"
 
+# Cost of every triangle command: 'command' is paid once and 'triangle' for every triangle it draws.
+# The defaults count commands as each is 8 bytes of display list to DMA and parse, with tie breakers for equal counts:
+# TRI3 is more RSP work than TRI2 and a snake continuation is more work than regular triangles.
+# Tune it for the microcode with --emit-costs.
+EMIT_COSTS = {
+    'gsSP1Triangle': { 'command': 1.0, 'triangle': 0.0 },
+    'gsSP2Triangles': { 'command': 1.0, 'triangle': 0.0 },
+    'gsSP3Triangles': { 'command': 1.02, 'triangle': 0.0 },
+    'gsSPTriSnake': { 'command': 1.0, 'triangle': 0.0 },
+    'gsSPContinueSnake': { 'command': 1.01, 'triangle': 0.0 },
+}
+
+# Triangles carried by a single command
+TRI_COMMAND_SIZES = { 'gsSP3Triangles': 3, 'gsSP2Triangles': 2, 'gsSP1Triangle': 1 }
+SNAKE_HEAD_SIZE = 5
+SNAKE_CONTINUE_SIZE = 8
+# Snake tail lengths tried when looking for the cheapest mix, trimming more only adds regular triangle commands
+SNAKE_MAX_TRIM = SNAKE_CONTINUE_SIZE
+
+def _command_cost(command, tris):
+    cost = EMIT_COSTS[command]
+    return cost['command'] + cost['triangle'] * tris
+
+def _snake_cost(length):
+    head = min(length, SNAKE_HEAD_SIZE)
+    cost = _command_cost('gsSPTriSnake', head)
+    for start in range(head, length, SNAKE_CONTINUE_SIZE):
+        cost += _command_cost('gsSPContinueSnake', min(SNAKE_CONTINUE_SIZE, length - start))
+    return cost
+
+def _plan_triangles(count):
+    # Cheapest split of up to 'count' regular triangles into commands, bigger commands win ties so they go first
+    commands = [ command for command in TRI_COMMAND_SIZES if HAS_TRI3 or 'gsSP3Triangles' != command ]
+    costs = [ 0.0 ]
+    firsts = [ None ]
+    for n in range(1, count + 1):
+        best_cost = None
+        best_command = None
+        for command in commands:
+            size = TRI_COMMAND_SIZES[command]
+            if size > n:
+                continue
+            cost = costs[n - size] + _command_cost(command, size)
+            if best_cost is None or cost < best_cost - 1e-9:
+                best_cost = cost
+                best_command = command
+        costs.append(best_cost)
+        firsts.append(best_command)
+    return costs, firsts
+
+def _format_triangles(command, tris):
+    if 'gsSP3Triangles' == command:
+        return f"\tgsSP3Triangles({', '.join(str(vtx) for tri in tris for vtx in tri)}),\n"
+    return f"\t{command}({', '.join(f'{tri[0]}, {tri[1]}, {tri[2]}, 0' for tri in tris)}),\n"
+
+def emit_draws(triangles, snakes):
+    # Display list lines drawing a render pass with the cheapest mix of commands under EMIT_COSTS.
+    # Snakes can give their tail to the regular triangles, or be dissolved, when that packs the triangles better.
+    best = { len(triangles): (0.0, []) }
+    for snake in snakes:
+        length = len(snake.turns) + 1
+        options = [ length - trim for trim in range(min(SNAKE_MAX_TRIM, length - 2) + 1) ] + [ 0 ]
+        step = {}
+        for loose, (cost, keeps) in best.items():
+            for keep in options:
+                keep_cost = cost + (_snake_cost(keep) if keep else 0.0)
+                key = loose + length - keep
+                if key not in step or keep_cost < step[key][0] - 1e-9:
+                    step[key] = keep_cost, keeps + [ keep ]
+        best = step
+
+    costs, firsts = _plan_triangles(max(best))
+    _, (_, keeps) = min(best.items(), key=lambda item: round(item[1][0] + costs[item[0]], 9))
+
+    loose = list(triangles)
+    kept_snakes = []
+    for snake, keep in zip(snakes, keeps):
+        length = len(snake.turns) + 1
+        if keep:
+            if keep != length:
+                loose.extend(snake.trim(length - keep))
+            kept_snakes.append(snake)
+        else:
+            loose.extend(snake.triangles())
+
+    draws = []
+    pos = 0
+    while pos < len(loose):
+        command = firsts[len(loose) - pos]
+        size = TRI_COMMAND_SIZES[command]
+        draws.append(_format_triangles(command, loose[pos:pos + size]))
+        pos += size
+
+    PROFILER.count('snakes', len(kept_snakes))
+    PROFILER.count('snake_tris', sum(len(snake.turns) + 1 for snake in kept_snakes))
+    for snake in kept_snakes:
+        draws.extend(snake.stringify_x())
+    return draws
+
 # Generate a shuffle that pins 'shared' vertices to the first 'len(shared)' indices
 def make_shuffle_pinning_shared(glo_to_loc, glo_shared):
     # Pin shared vertices to indices from 0 to len(glo_shared) - 1
@@ -300,6 +611,46 @@ def make_shuffle_pinning_shared_limited(glo_to_loc, glo_shared, lim):
 
     return shuffle
 
+# Generate a shuffle that pins 'shared' vertices to the last 'len(shared)' indices of the range from 'lo' to 'hi'
+# Vertices outside of the range are not moved.
+def make_shuffle_pinning_shared_right(glo_to_loc, glo_shared, lo, hi):
+    glo_shared_to_loc = {}
+    for glo in glo_shared:
+        glo_shared_to_loc[glo] = hi - len(glo_shared) + len(glo_shared_to_loc)
+
+    shuffle = {}
+    loc_unpinned_start = lo
+
+    for glo in sorted(glo_to_loc, key=glo_to_loc.get):
+        loc = glo_to_loc[glo]
+        if loc < lo or loc >= hi:
+            shuffle[loc] = loc
+        elif glo in glo_shared_to_loc:
+            shuffle[loc] = glo_shared_to_loc[glo]
+        else:
+            shuffle[loc] = loc_unpinned_start
+            loc_unpinned_start += 1
+
+    return shuffle
+
+# Generate a shuffle that keeps the first 'lim' indices, puts 'shared' vertices to 'glo_shared_to_loc'
+# and packs all other vertices right after the first 'lim' indices
+def make_shuffle_pinned_right(glo_to_loc, glo_shared_to_loc, lim):
+    shuffle = {}
+    loc_unpinned_start = lim
+
+    for glo in sorted(glo_to_loc, key=glo_to_loc.get):
+        loc = glo_to_loc[glo]
+        if loc < lim:
+            shuffle[loc] = loc
+        elif glo in glo_shared_to_loc:
+            shuffle[loc] = glo_shared_to_loc[glo]
+        else:
+            shuffle[loc] = loc_unpinned_start
+            loc_unpinned_start += 1
+
+    return shuffle
+
 def apply_shuffle(render_pass: RenderPass, shuffle):
     for glo_vtx in render_pass.vertices:
         loc_vtx = render_pass.vertices[glo_vtx]
@@ -411,148 +762,238 @@ class TriKit:
         return v2 not in path[2]
 
     @staticmethod
-    def _strip_can_continue(path, ntri):
+    def _strip_can_continue(tris, path, ntri):
+        # 'path' and 'ntri' are triangle ids in 'tris'
+        ptri = tris[path[-1]]
+        ntri = tris[ntri]
         # Not currently supported triangle rendered on top of each other flipped - some algos break badly
-        if path[-1][0] == ntri[0] and path[-1][1] == ntri[2] and path[-1][2] == ntri[1]:
+        if ptri[0] == ntri[0] and ptri[1] == ntri[2] and ptri[2] == ntri[1]:
             return False
 
         if len(path) < 2:
             return True
 
-        ptri = path[-1]
-        pptri = path[-2]
+        pptri = tris[path[-2]]
         v = TriKit._v_in_triA_not_in_triB(ptri, pptri)
         # Only very awful triangles will not satisfy this condition - edge of a tri is going shared between 3 triangles
         return v in ntri
 
     @staticmethod
-    def build_strip_tri_to_tris(tris, can_link=None):
-        # Build the strips tree. The way it is built is using a temporary edge->tri mapping to link the tree...
-        edge_to_tris = {}
-        for tri in tris:
-            # Mind that edge is flipped here because the next tri in strip will have the edge in reverse order
-            for edge in TriKit._edges_reverse(tri):
-                if edge not in edge_to_tris:
-                    edge_to_tris[edge] = []
-                edge_to_tris[edge].append(tri)
+    def build_traverse_order(neighbours):
+        # Try to find the best start of the strip - the "loneliest" triangle with the least amount of neighbours.
+        # Ties keep the triangle order so the output does not depend on hashing.
+        if not neighbours or max(len(ntris) for ntris in neighbours) < 2:
+            # Not enough neighbours to form any kind of strip
+            return None
 
-        strip_tri_to_tris = {}
-        # ...and iterating the triangles again linking the triangles
-        for tri in tris:
-            for edge in TriKit._edges(tri):
-                if edge not in edge_to_tris:
+        return sorted(range(len(neighbours)), key=lambda tri: len(neighbours[tri]))
+
+    @staticmethod
+    def _strip_longest_path_dfs(tris, neighbours, taken, tri):
+        stack = [(tri, [tri])]
+        longest_path = [tri]
+        limit = WALK_LIMIT
+        log_debug(f"\nDFS: Starting with triangle {tris[tri]} for len {len(tris)}")
+        while stack and limit:
+            limit -= 1
+            curr, path = stack.pop()
+            for ntri in neighbours[curr]:
+                if not taken[ntri] and ntri not in path and TriKit._strip_can_continue(tris, path, ntri):
+                    new_path = path + [ntri]
+                    if len(new_path) > len(longest_path):
+                        longest_path = new_path
+
+                    stack.append((ntri, new_path))
+
+        PROFILER.count('dfs_nodes', WALK_LIMIT - limit)
+        if stack:
+            PROFILER.count('walk_limit_hits')
+        return longest_path
+
+    @staticmethod
+    def _strip_lookahead(tris, neighbours, path, visited, depth):
+        # Bounded DFS telling how many more triangles the strip can take after 'path'.
+        # With at most 3 neighbours per triangle this is at most 3^depth steps.
+        if not depth:
+            return 0
+
+        best = 0
+        for ntri in neighbours[path[-1]]:
+            if visited[ntri] or not TriKit._strip_can_continue(tris, path, ntri):
+                continue
+
+            path.append(ntri)
+            visited[ntri] = True
+            best = max(best, 1 + TriKit._strip_lookahead(tris, neighbours, path, visited, depth - 1))
+            visited[ntri] = False
+            path.pop()
+            if best == depth:
+                break
+
+        return best
+
+    @staticmethod
+    def _strip_extend_greedy(tris, neighbours, path, visited):
+        # Grow the strip one triangle at a time picking the neighbour that can go the furthest within the lookahead.
+        # Ties are broken by the amount of free neighbours - the loneliest triangle is the one likely to be left out
+        # otherwise - and then by the triangle itself so output does not depend on the neighbour order.
+        while True:
+            best_tri = None
+            best_key = None
+            for ntri in neighbours[path[-1]]:
+                if visited[ntri] or not TriKit._strip_can_continue(tris, path, ntri):
                     continue
 
-                for ntri in edge_to_tris[edge]:
-                    if can_link and not can_link(tri, ntri):
-                        continue
+                path.append(ntri)
+                visited[ntri] = True
+                reach = TriKit._strip_lookahead(tris, neighbours, path, visited, STRIP_LOOKAHEAD)
+                PROFILER.count('greedy_candidates')
+                free = sum(1 for nntri in neighbours[ntri] if not visited[nntri])
+                visited[ntri] = False
+                path.pop()
+
+                key = (-reach, free, tris[ntri])
+                if best_key is None or key < best_key:
+                    best_key = key
+                    best_tri = ntri
 
-                    if ntri not in strip_tri_to_tris:
-                        strip_tri_to_tris[ntri] = set()
-                    strip_tri_to_tris[ntri].add(tri)
+            if best_tri is None:
+                return path
 
-        return strip_tri_to_tris
+            path.append(best_tri)
+            visited[best_tri] = True
 
     @staticmethod
-    def build_traverse_order(strip_tri_to_tris):
-        # This provides us with doubly linked triangles list for strips generation.
-        # Try to find the best start of the strip - the "loneliest" triangle with the least amount of neighbours
-        neighbour_count_to_tri = {}
-        for tri in strip_tri_to_tris:
-            neighbour_count = len(strip_tri_to_tris[tri])
-            if neighbour_count not in neighbour_count_to_tri:
-                neighbour_count_to_tri[neighbour_count] = set()
-            neighbour_count_to_tri[neighbour_count].add(tri)
-
-        if not neighbour_count_to_tri or max(neighbour_count_to_tri.keys()) < 2:
-            # Not enough neighbours to form any kind of strip
-            return None
+    def _strip_longest_path_greedy(tris, neighbours, taken, tri):
+        # Polynomial alternative to the DFS: walk forward greedily from the seed and then walk backward.
+        # Strips are symmetric so the backward walk is just a forward walk over the reversed path.
+        # Triangles already in strips count as visited so 'taken' is walked in place, the path ends up taken either way.
+        taken[tri] = True
+        path = TriKit._strip_extend_greedy(tris, neighbours, [tri], taken)
+        path.reverse()
+        path = TriKit._strip_extend_greedy(tris, neighbours, path, taken)
+        path.reverse()
+        return path
+
+    # Forsyth's linear-speed vertex cache optimisation tuned for the vertex buffer instead of a post-transform cache.
+    # Vertices used by the last triangle are scored flat so the order does not favour any corner.
+    FORSYTH_CACHE_DECAY_POWER = 1.5
+    FORSYTH_LAST_TRI_SCORE = 0.75
+    FORSYTH_VALENCE_BOOST_SCALE = 2.0
+    FORSYTH_VALENCE_BOOST_POWER = 0.5
+
+    @staticmethod
+    def _forsyth_vtx_score(cache_pos, valence, cache_size):
+        if not valence:
+            return -1.0
+
+        score = 0.0
+        if cache_pos < 0:
+            pass
+        elif cache_pos < 3:
+            score = TriKit.FORSYTH_LAST_TRI_SCORE
+        else:
+            score = (1.0 - (cache_pos - 3) / (cache_size - 3)) ** TriKit.FORSYTH_CACHE_DECAY_POWER
+
+        return score + TriKit.FORSYTH_VALENCE_BOOST_SCALE * valence ** -TriKit.FORSYTH_VALENCE_BOOST_POWER
+
+    @staticmethod
+    def reorder_for_cache(triangles, cache_size):
+        # Greedily emit the triangle with the best score where vertices recently used score higher
+        # and vertices with few triangles left score higher so they leave the buffer early.
+        vtx_tris = {}
+        for i, tri in enumerate(triangles):
+            for vtx in tri:
+                vtx_tris.setdefault(vtx, []).append(i)
+
+        valence = { vtx: len(tris) for vtx, tris in vtx_tris.items() }
+        vtx_score = { vtx: TriKit._forsyth_vtx_score(-1, valence[vtx], cache_size) for vtx in vtx_tris }
+        emitted = [ False ] * len(triangles)
+        order = []
+        cache = []
+        # Fallback for when nothing in the cache has triangles left, keeps the original order of disconnected parts
+        next_unemitted = 0
+        best = None
+        while len(order) < len(triangles):
+            if best is None:
+                while emitted[next_unemitted]:
+                    next_unemitted += 1
+                best = next_unemitted
+
+            tri = triangles[best]
+            emitted[best] = True
+            order.append(tri)
+            for vtx in tri:
+                valence[vtx] -= 1
+                vtx_tris[vtx].remove(best)
+
+            cache = list(tri) + [ vtx for vtx in cache if vtx not in tri ]
+            evicted = cache[cache_size:]
+            del cache[cache_size:]
+
+            touched_tris = set()
+            for pos, vtx in enumerate(cache):
+                vtx_score[vtx] = TriKit._forsyth_vtx_score(pos, valence[vtx], cache_size)
+                touched_tris.update(vtx_tris[vtx])
+            for vtx in evicted:
+                vtx_score[vtx] = TriKit._forsyth_vtx_score(-1, valence[vtx], cache_size)
+                touched_tris.update(vtx_tris[vtx])
+
+            best = None
+            best_score = -1.0
+            for i in sorted(touched_tris):
+                score = sum(vtx_score[vtx] for vtx in triangles[i])
+                if score > best_score:
+                    best = i
+                    best_score = score
+
+        return order
 
-        dfs_tri_traverse_order = []
-        for count in sorted(neighbour_count_to_tri.keys()):
-            dfs_tri_traverse_order.extend(list(neighbour_count_to_tri[count]))
-        
-        return dfs_tri_traverse_order
+    @staticmethod
+    def stripify(triangles, neighbours=None):
+        # 'neighbours' is the strip adjacency of 'triangles' if the caller already has it sliced from its mesh
+        with PROFILER.phase('stripify'):
+            return TriKit._stripify(triangles, neighbours)
 
     @staticmethod
-    def stripify(triangles):
-            rendered_triangles = triangles[:]
+    def _stripify(triangles, neighbours):
             if not HAS_EX3_COMMANDS:
-                return rendered_triangles, []
+                return triangles[:], []
 
-            rendered_snakes = []
-            strip_tri_to_tris = TriKit.build_strip_tri_to_tris(rendered_triangles)
-            dfs_tri_traverse_order = TriKit.build_traverse_order(strip_tri_to_tris)
+            if neighbours is None:
+                neighbours = StripAdjacency(triangles).slice(range(len(triangles)))
+
+            dfs_tri_traverse_order = TriKit.build_traverse_order(neighbours)
             if not dfs_tri_traverse_order:
-                return rendered_triangles, []
-
-            # This provides us with doubly linked triangles list for strips generation.
-            # Try to find the best start of the strip - the "loneliest" triangle with the least amount of neighbours
-            neighbour_count_to_tri = {}
-            for tri in strip_tri_to_tris:
-                neighbour_count = len(strip_tri_to_tris[tri])
-                if neighbour_count not in neighbour_count_to_tri:
-                    neighbour_count_to_tri[neighbour_count] = set()
-                neighbour_count_to_tri[neighbour_count].add(tri)
-
-            if not neighbour_count_to_tri or max(neighbour_count_to_tri.keys()) < 2:
-                # Not enough neighbours to form any kind of strip
-                return rendered_triangles, []
-
-            dfs_tri_traverse_order = []
-            for count in sorted(neighbour_count_to_tri.keys()):
-                dfs_tri_traverse_order.extend(list(neighbour_count_to_tri[count]))
-            
-            del neighbour_count_to_tri
-
-            def remove_tri(tri):
-                rendered_triangles.remove(tri)
+                return triangles[:], []
+
+            rendered_snakes = []
+            # Triangles that are already in a strip, they are skipped by the walks instead of being unlinked
+            taken = [ False ] * len(triangles)
+            snaked = [ False ] * len(triangles)
 
             # Now we need to dfs through each triangle to find the strips
             # Start with lighest triangles that have the least amount of neighbours
             # Because each render pass is by amount of vertices, we can just dfs each triangle without too much cost.
             for tri in dfs_tri_traverse_order:
                 # Check if it was already rendered as part of a strip
-                if tri not in strip_tri_to_tris:
+                if taken[tri] or not neighbours[tri]:
                     continue
 
-                stack = [(tri, [tri])]
-                longest_path = [tri]
-                limit = WALK_LIMIT
-                print(f"\nDFS: Starting with triangle {tri} for len {len(strip_tri_to_tris)}")
-                while stack and limit:
-                    limit -= 1
-                    curr, path = stack.pop()
-                    # Note that dfs is allowed to do 'strip_tri_to_tris[curr]' because it is doubly linked
-                    # Conveniently we will get an exception is something went wrong in 'strip_tri_to_tris' generation
-                    for ntri in strip_tri_to_tris[curr]:
-                        if ntri not in path and TriKit._strip_can_continue(path, ntri):
-                            new_path = path + [ntri]
-                            if len(new_path) > len(longest_path):
-                                longest_path = new_path
-
-                            stack.append((ntri, new_path))
+                if STRIP_ALGO == 'dfs':
+                    longest_path = TriKit._strip_longest_path_dfs(triangles, neighbours, taken, tri)
+                else:
+                    longest_path = TriKit._strip_longest_path_greedy(triangles, neighbours, taken, tri)
 
                 # We got the path, evict all triangles that are in the path
-                for tri in longest_path:
-                    if not tri in strip_tri_to_tris:
-                        continue
-                    for ntri in strip_tri_to_tris.pop(tri):
-                        strip_tri_to_tris[ntri].remove(tri)
-                        if not strip_tri_to_tris[ntri]:
-                            del strip_tri_to_tris[ntri]
+                for ptri in longest_path:
+                    taken[ptri] = True
 
                 if len(longest_path) > 2:
-                    # Trim the snake tail - there is no point to store 1 triangle at the end of the strip
-                    # because they can easily be expressed as regular triangles without perf cost 
-                    longest_path_tail = (len(longest_path) - 5) % 8
-                    if len(longest_path) > 5 and (longest_path_tail == 1 or longest_path_tail == 2):
-                        longest_path.pop()
-                        if longest_path_tail == 2:
-                            longest_path.pop()
-
-                    for tri in longest_path:
-                        remove_tri(tri)
+                    # The whole path goes to the snake, 'emit_draws' decides if its tail is cheaper as regular triangles
+                    for ptri in longest_path:
+                        snaked[ptri] = True
+                    longest_path = [ triangles[ptri] for ptri in longest_path ]
 
                     # Need to figure out the first turn. It depends on the first 3 triangles in the path
                     t1 = longest_path[0]
@@ -629,8 +1070,35 @@ class TriKit:
 
             # We are converting tri to list because vtx load optimizer will want to mangle tri vertices
             # We will never need to compare the triangles so this is fine
+            rendered_triangles = [ tri for i, tri in enumerate(triangles) if not snaked[i] ]
             return rendered_triangles, rendered_snakes
 
+class StripAdjacency:
+    # Strip links of every triangle of a mesh by triangle id: two triangles are linked if they share an edge
+    # going in opposite directions. Neighbours of triangle 'i' are 'neighbours[offsets[i]:offsets[i + 1]]'.
+    # It is built once per mesh and each render pass slices the triangles it got.
+    def __init__(self, triangles):
+        edge_to_tris = {}
+        for i, tri in enumerate(triangles):
+            # Mind that edge is flipped here because the next tri in strip will have the edge in reverse order
+            for edge in TriKit._edges_reverse(tri):
+                edge_to_tris.setdefault(edge, []).append(i)
+
+        self.offsets = [ 0 ]
+        self.neighbours = []
+        for tri in triangles:
+            start = len(self.neighbours)
+            for edge in TriKit._edges(tri):
+                for ntri in edge_to_tris.get(edge, ()):
+                    if ntri not in self.neighbours[start:]:
+                        self.neighbours.append(ntri)
+            self.offsets.append(len(self.neighbours))
+
+    def slice(self, tri_ids):
+        # Neighbour lists of the 'tri_ids' triangles only, renumbered by their position in 'tri_ids'
+        local_ids = { tri_id: i for i, tri_id in enumerate(tri_ids) }
+        return [ [ local_ids[ntri] for ntri in self.neighbours[self.offsets[tri_id]:self.offsets[tri_id + 1]] if ntri in local_ids ] for tri_id in tri_ids ]
+
 class Vec3:
     def __init__(self, x, y, z):
         self.x = x
@@ -664,9 +1132,7 @@ class Vec3:
         return [self.x, self.y, self.z]
 
 class Vtx:
-    def __init__(self, line):
-        ls = [ tok.replace('{', '').replace('}', '').strip() for tok in line.split(',') ]
-        ls = [ int(tok) for tok in ls if tok ]
+    def __init__(self, ls):
         self.pos = Vec3(ls[0], ls[1], ls[2])
         self.uv = [ ls[4], ls[5] ]
         self.color = [ ls[6], ls[7], ls[8], ls[9] ]
@@ -674,6 +1140,39 @@ class Vtx:
     def __repr__(self):
         return f"Vtx(pos={self.pos}, uv={self.uv}, color={self.color})"
 
+# Names VtxFilter expressions see, one array per VTX_STRUCT field
+VTX_FIELDS = [ 'x', 'y', 'z', 'flag', 'u', 'v', 'r', 'g', 'b', 'a' ]
+
+class VtxFilter:
+    # Vectorized VTX_FILTER: 'expr' is evaluated once per chunk over arrays of all of its vertices,
+    # 'box' as (x0, y0, z0, x1, y1, z1) drops vertices outside of it. Both can be given, a vertex is dropped if either says so.
+    def __init__(self, expr=None, box=None):
+        self.expr = expr
+        self.box = tuple(box) if box else None
+        self._code = compile(expr, '<vtx filter>', 'eval') if expr else None
+
+    def __reduce__(self):
+        # Code objects do not pickle, worker processes compile the expression again
+        return VtxFilter, (self.expr, self.box)
+
+    def key(self):
+        return [ self.expr, self.box ]
+
+    def mask(self, records):
+        # Bool array, True for every dropped record
+        import numpy as np
+
+        fields = np.frombuffer(b''.join(records), dtype=np.dtype('<i2')).reshape(-1, len(VTX_FIELDS)).astype(np.int32)
+        fields[:, VTX_FIELDS.index('flag')] &= 0xFFFF
+        columns = dict(zip(VTX_FIELDS, fields.T))
+        skipped = np.zeros(len(records), dtype=bool)
+        if self._code:
+            skipped |= np.broadcast_to(np.asarray(eval(self._code, { '__builtins__': {}, 'np': np }, columns), dtype=bool), skipped.shape)
+        if self.box:
+            poss = fields[:, :3]
+            skipped |= ((poss < self.box[:3]) | (poss > self.box[3:])).any(axis=1)
+        return skipped
+
 class BaryPreCalc:
     def __init__(self, tri):
         diffs = [ e[0].pos - e[1].pos for e in TriKit._edges(tri) ]
@@ -703,6 +1202,54 @@ class BaryPreCalc:
 
         return l0, l1, l2
 
+    @staticmethod
+    def batch(tri_poss, vtx_poss, margin=0, tolerance=1e-2):
+        # 'try_conv' of every vertex against every triangle of a chunk at once, 'tri_poss' is [N, 3, 3] and
+        # 'vtx_poss' is [M, 3]. Only pairs where the vertex is in the triangle bounding box grown by 'margin' are
+        # tested: vertices are sorted by x and every triangle binary searches its x range before y and z are checked.
+        # Returns vertex ids, triangle ids, coplanarity and barycentric weights in the triangle vertex order
+        # normalized to add up to 1, one row per tested pair. Degenerate triangles are never coplanar.
+        import numpy as np
+
+        tri_poss = np.asarray(tri_poss, dtype=np.float64).reshape(-1, 3, 3)
+        vtx_poss = np.asarray(vtx_poss, dtype=np.float64).reshape(-1, 3)
+        lo = tri_poss.min(axis=1) - margin
+        hi = tri_poss.max(axis=1) + margin
+
+        order = np.argsort(vtx_poss[:, 0], kind='stable')
+        starts = np.searchsorted(vtx_poss[order, 0], lo[:, 0], side='left')
+        counts = np.searchsorted(vtx_poss[order, 0], hi[:, 0], side='right') - starts
+        tri_ids = np.repeat(np.arange(len(tri_poss)), counts)
+        pair_offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        vtx_ids = order[np.repeat(starts, counts) + pair_offsets]
+        inside = np.all((vtx_poss[vtx_ids] >= lo[tri_ids]) & (vtx_poss[vtx_ids] <= hi[tri_ids]), axis=1)
+        vtx_ids = vtx_ids[inside]
+        tri_ids = tri_ids[inside]
+
+        # Same rotation as the constructor - the shortest edge goes first
+        edges = tri_poss - np.roll(tri_poss, -1, axis=1)
+        rotation = np.argmin(np.einsum('nij,nij->ni', edges, edges), axis=1)[tri_ids]
+        corners = (rotation[:, None] + np.arange(3)) % 3
+        r = tri_poss[tri_ids[:, None], corners]
+        vtx = vtx_poss[vtx_ids]
+
+        def dot(a, b):
+            return np.einsum('ij,ij->i', a, b)
+
+        tv = np.cross(r[:, 0] - r[:, 2], r[:, 1] - r[:, 2])
+        tv2 = dot(tv, tv)
+        dr2 = vtx - r[:, 2]
+        coplanar = (tv2 > 0) & (np.abs(dot(dr2, tv)) <= np.sqrt(dot(dr2, dr2) * tv2) * tolerance)
+
+        rotated_weights = np.stack([
+            dot(np.cross(dr2, r[:, 1] - r[:, 2]), tv),
+            dot(np.cross(dr2, r[:, 2] - r[:, 0]), tv),
+            dot(np.cross(vtx - r[:, 0], r[:, 0] - r[:, 1]), tv),
+        ], axis=1) / np.where(tv2 > 0, tv2, 1)[:, None]
+        weights = np.empty_like(rotated_weights)
+        weights[np.arange(len(tri_ids))[:, None], corners] = rotated_weights
+        return vtx_ids, tri_ids, coplanar, weights
+
     def __repr__(self):
         return f"BaryPreCalc(t={self.t}, r={self.r}, dr={self.dr}, tv={self.tv}, tl={self.tl})"
 
@@ -734,11 +1281,135 @@ class ShapelyAdapter:
         key = (int(poly[0]), int(poly[1]))
         return self._cache[key]
 
+def retriangulate_region(table, region, vtx_values, poss, attrs, normal):
+    # Union the coplanar 'region' triangles into a polygon and triangulate it again using its border vertices only.
+    # Vertices on the region border all stay so neighbouring triangles get no T-junctions. Kept vertices keep their
+    # own UV and color so the region is only taken if the new triangles interpolate the attributes of every
+    # removed vertex within RETRI_ATTR_TOLERANCE. Returns None when the region cannot be done or gets no smaller.
+    import numpy as np
+    import shapely
+    from shapely.geometry import Polygon
+    from shapely.ops import triangulate, unary_union
+
+    edges = set(edge for tri in region for edge in TriKit._edges(table.rows[tri]))
+    border = set(vtx for a, b in edges if (b, a) not in edges for vtx in (a, b))
+    inner = sorted(set(vtx for a, b in edges for vtx in (a, b)) - border)
+    if not inner:
+        return None
+
+    in_region = set(region)
+    if any(tri not in in_region for vtx in inner for tri in table.vtx_tris[vtx]):
+        return None
+
+    adapter = ShapelyAdapter(Vec3(*normal))
+    if len(set(adapter.vtx_to_2d(vtx_values[vtx].pos, vtx) for vtx in border.union(inner))) != len(border) + len(inner):
+        # Different vertices at the same spot, a seam inside the region
+        return None
+
+    pieces = [ Polygon([ adapter.vtx_to_2d(vtx_values[vtx].pos, vtx) for vtx in table.rows[tri] ]) for tri in region ]
+    polygon = unary_union(pieces)
+    if polygon.geom_type != 'Polygon' or abs(polygon.area - sum(piece.area for piece in pieces)) > 1e-6 * polygon.area:
+        # Region touching itself in a single vertex or folding over itself
+        return None
+
+    try:
+        if set(adapter.vtx_from_2d(xy) for ring in [ polygon.exterior, *polygon.interiors ] for xy in ring.coords) != border:
+            return None
+
+        if hasattr(shapely, 'constrained_delaunay_triangles'):
+            pieces = list(shapely.constrained_delaunay_triangles(polygon).geoms)
+        else:
+            pieces = [ piece for piece in triangulate(polygon) if polygon.contains(piece.representative_point()) ]
+        if abs(sum(piece.area for piece in pieces) - polygon.area) > 1e-6 * polygon.area:
+            return None
+
+        new_tris = [ [ adapter.vtx_from_2d(xy) for xy in piece.exterior.coords[:3] ] for piece in pieces ]
+    except KeyError:
+        # Union or triangulation made up a point
+        return None
+
+    if len(new_tris) >= len(region):
+        return None
+
+    for i, tri in enumerate(new_tris):
+        facing = np.cross(poss[tri[1]] - poss[tri[0]], poss[tri[2]] - poss[tri[0]]) @ normal
+        if not facing:
+            return None
+        if facing < 0:
+            tri = [ tri[0], tri[2], tri[1] ]
+        new_tris[i] = TriKit._tri_normalize(tuple(tri))
+
+    vtx_ids, tri_ids, coplanar, weights = BaryPreCalc.batch(poss[np.array(new_tris)], poss[inner], margin=1)
+    covered = set()
+    for vtx_id, tri_id, tri_weights in zip(vtx_ids[coplanar], tri_ids[coplanar], weights[coplanar]):
+        if tri_weights.min() < -1e-6:
+            continue
+        if np.abs(tri_weights @ attrs[list(new_tris[tri_id])] - attrs[inner[vtx_id]]).max() > RETRI_ATTR_TOLERANCE:
+            return None
+        covered.add(vtx_id)
+
+    if len(covered) != len(inner):
+        return None
+
+    return new_tris
+
+def cull_volume(vtx_values, max_extent=CULL_MAX_EXTENT):
+    # Vertices whose convex hull contains the whole mesh: indices of the hull vertices when there are few of them,
+    # otherwise the records of the bounding box corners. Neither when culling is not worth it.
+    poss = [ vtx.pos.as_list() for vtx in vtx_values ]
+    lo = [ min(pos[axis] for pos in poss) for axis in range(3) ]
+    hi = [ max(pos[axis] for pos in poss) for axis in range(3) ]
+    if max_extent is not None and max(hi[axis] - lo[axis] for axis in range(3)) > max_extent:
+        return [], []
+
+    if CULL_MODE == 'auto':
+        import numpy as np
+        from scipy.spatial import ConvexHull
+
+        np_vtx_poss = np.array(poss)
+        try:
+            np_vtx_poss_hull_indices = [ int(i) for i in ConvexHull(np_vtx_poss).vertices ]
+        except Exception:
+            # Flat meshes have no volume, the bounding box handles them fine
+            np_vtx_poss_hull_indices = []
+
+        if np_vtx_poss_hull_indices and len(np_vtx_poss_hull_indices) <= CULL_HULL_MAX_VERTICES:
+            PROFILER.count('cull_hull')
+            return np_vtx_poss_hull_indices, []
+
+    # Corners collapse on flat bounding boxes
+    corners = sorted(set((x, y, z) for x in (lo[0], hi[0]) for y in (lo[1], hi[1]) for z in (lo[2], hi[2])))
+    PROFILER.count('cull_aabb')
+    return [], [ VTX_STRUCT.pack(x, y, z, 0, 0, 0, 0, 0, 0, 0) for x, y, z in corners ]
+
 class ParserVbo:
     def __init__(self):
         self.vertices_model_name = None
+        self.vertices_model_entry = None
+        # (vertices model entry, index) of each loaded vertex
         self.vbo = [ None ] * 64
 
+    def load(self, model, args):
+        vtx_arg = args[0]
+        vtx_arg_split = vtx_arg.split(' ')
+
+        vertices_model_name = vtx_arg_split[0]
+        if self.vertices_model_name != vertices_model_name:
+            self.vertices_model_name = vertices_model_name
+            _, model_entry = model.find(vertices_model_name)
+            self.vertices_model_entry = model_entry
+
+        if len(vtx_arg_split) > 1:
+            assert '+' == vtx_arg_split[1], "incorrect vtx declaration"
+            vtx_offset = int(vtx_arg_split[2])
+        else:
+            vtx_offset = 0
+
+        num = int(args[1])
+        vbo_offset = int(args[2])
+        for i in range(num):
+            self.vbo[vbo_offset + i] = self.vertices_model_entry, vtx_offset + i
+
 class ModelMeshEntry(TriKit):
     def __init__(self, next_line, model, vtxopt_name, parser_vbo):
         self._model = model
@@ -756,15 +1427,71 @@ class ModelMeshEntry(TriKit):
                 self._base_vertices_model_entry.name = self._base_vertices_model_entry.name + f"_{vtx_arg_split[2]}"
                 self._base_vertices_model_entry.raw_name = self._base_vertices_model_entry.raw_name.replace(orig_name, self._base_vertices_model_entry.name)
 
+        # VTX_STRUCT records, deduplicated on their bytes
         self._vertices = []
         self._vertices_lookup = {}
         self._triangles = []
         self._triangles_lookup = set()
 
         self.parser = parser_vbo
-
-    def _vtx(self, vertex):
-        assert vertex
+        self.cullable = False
+        # Compiled right after the previous chunk of the list and gets the buffer it left
+        self.shares_buffer = False
+
+    def cache_key(self, have_tile, vtx_filter):
+        # Everything compile() output depends on. The optimizer source is part of the key so any
+        # change to the algorithm invalidates the cache on its own.
+        h = hashlib.sha256()
+        h.update(_source_digest())
+        h.update(json.dumps([ _compile_settings(), _filter_key(vtx_filter), bool(have_tile), self.cullable, self.shares_buffer, self._triangles ]).encode())
+        h.update(b''.join(self._vertices))
+        return h.hexdigest()
+
+    def compile_from_cache(self, draws, records):
+        # Same as compile() but with the results coming from the cache
+        assert self._base_vertices_model_entry is not None, "compile() called twice"
+        vtx_entry = self._base_vertices_model_entry
+        vtx_entry.used = True
+        vtx_entry.records = records
+        self._base_vertices_model_entry = None
+        self._record_mesh(draws, vtx_entry)
+        return [ draw.replace(CACHE_NAME_TOKEN, vtx_entry.name) for draw in draws ], vtx_entry
+
+    def _record_mesh(self, draws, vtx_entry):
+        vtx_loads = sum(1 for draw in draws if 'gsSPVertex' in draw)
+        log_debug(f"{vtx_entry.name}: {len(self._triangles)} triangles, {len(self._vertices)} vertices, {len(vtx_entry)} loaded in {vtx_loads} loads")
+        PROFILER.mesh(vtx_entry.name, triangles=len(self._triangles), vertices=len(self._vertices), vtx_loaded=len(vtx_entry), vtx_loads=vtx_loads)
+
+    def vtx_entry_name(self):
+        return self._base_vertices_model_entry.name
+
+    def detach(self):
+        # Parsing is done - drop references to the whole model so the entry is cheap to send to another process
+        self._model = None
+        self.parser = None
+
+    def subset(self, vtxopt_name, tri_ids):
+        # New chunk with the triangles 'tri_ids' of this one, for split_list()
+        entry = ModelMeshEntry.__new__(ModelMeshEntry)
+        entry._model = self._model
+        entry._name = vtxopt_name
+        entry._base_vertices_model_entry = ModelVtxEntry(f'static Vtx {vtxopt_name}_vtx{VTX_SUFFIX}[] = {{\n')
+        entry._vertices = self._vertices
+        entry._vertices_lookup = {}
+        entry._triangles_lookup = set()
+        entry.parser = None
+        entry.cullable = False
+        entry.shares_buffer = False
+        entry._reindex([ self._triangles[i] for i in tri_ids ])
+        return entry
+
+    def _vtx_values(self):
+        return [ Vtx(VTX_STRUCT.unpack(record)) for record in self._vertices ]
+
+    def _vtx(self, vbo_vertex):
+        assert vbo_vertex
+        model_entry, model_idx = vbo_vertex
+        vertex = model_entry.record(model_idx)
         if vertex in self._vertices_lookup:
             return self._vertices_lookup[vertex]
         else:
@@ -831,103 +1558,312 @@ class ModelMeshEntry(TriKit):
         return longest_link
 
 
-    def add(self, data):
-        if 'gsSPVertex' in data:
-            args = get_args(data)
-            vtx_arg = args[0]
-            vtx_arg_split = vtx_arg.split(' ')
-
-            vertices_model_name = vtx_arg_split[0]
-            if self.parser.vertices_model_name != vertices_model_name:
-                self.parser.vertices_model_name = vertices_model_name
-                _, model_entry = self._model.find(vertices_model_name)
-                self.parser.vertices_model_entry = model_entry
-
-            if len(vtx_arg_split) > 1:
-                assert '+' == vtx_arg_split[1], "incorrect vtx declaration"
-                vtx_offset = int(vtx_arg_split[2])
-            else:
-                vtx_offset = 0
-
-            num = int(args[1])
-            vbo_offset = int(args[2])
-            for i in range(num):
-                self.parser.vbo[vbo_offset + i] = self.parser.vertices_model_entry.vertices[vtx_offset + i]
-
+    def add(self, draw):
+        cmd, args = draw
+        if 'gsSPVertex' == cmd:
+            self.parser.load(self._model, args)
             return
 
-        if 'gsSP2Triangles' in data:
-            args = get_args(data)
+        if 'gsSP2Triangles' == cmd:
             self._tri([ int(args[0]), int(args[1]), int(args[2]) ])
             self._tri([ int(args[4]), int(args[5]), int(args[6]) ])
             return
 
-        if 'gsSP1Triangle' in data:
-            args = get_args(data)
+        if 'gsSP1Triangle' == cmd:
             self._tri([ int(args[0]), int(args[1]), int(args[2]) ])
             return
 
-        if 'gsSPEndDisplayList' in data:
-            return
-        if '};\n' == data:
-            return
-
-        assert False, f"unknown command: {data}"
+        assert False, f"unknown command: {cmd}"
 
     @staticmethod
-    def _make_render_pass(triangles, vertices):
-        triangles, snakes = TriKit.stripify(triangles)
+    def _make_render_pass(triangles, tri_ids, vertices, adjacency):
+        # 'tri_ids' are the mesh triangle ids of 'triangles'
+        neighbours = adjacency.slice(tri_ids) if adjacency is not None else None
+
+        triangles, snakes = TriKit.stripify(triangles, neighbours)
         return RenderPass(vertices, [ list(tri) for tri in triangles ], snakes)
 
-    def compile(self, have_tile, vtx_filter):
-        assert self._base_vertices_model_entry, "compile() called twice"
+    def _pin_resident(self, render_pass, resident):
+        # Find the biggest set of resident vertices that can stay where they are while the rest of the pass
+        # is loaded as one contiguous range of the buffer around them
+        record_to_loc = {}
+        for loc, record in sorted(resident.items()):
+            record_to_loc.setdefault(record, loc)
+        shared = { vtx: record_to_loc[self._vertices[vtx]] for vtx in render_pass.vertices if self._vertices[vtx] in record_to_loc }
+        if not shared:
+            return None
+
+        for count in range(len(shared), 0, -1):
+            load_amount = len(render_pass.vertices) - count
+            for lo in range(0, VTX_BUF_SIZE - load_amount + 1):
+                outside = [ vtx for vtx, loc in shared.items() if not lo <= loc < lo + load_amount ]
+                if len(outside) < count:
+                    continue
+
+                pinned = { vtx: shared[vtx] for vtx in sorted(outside, key=shared.get)[:count] }
+                shuffle = {}
+                loc_unpinned_start = lo
+                for vtx in sorted(render_pass.vertices, key=render_pass.vertices.get):
+                    if vtx in pinned:
+                        shuffle[render_pass.vertices[vtx]] = pinned[vtx]
+                    else:
+                        shuffle[render_pass.vertices[vtx]] = loc_unpinned_start
+                        loc_unpinned_start += 1
+                log_debug(f"apply resident shuffle {shuffle}")
+                apply_shuffle(render_pass, shuffle)
+                PROFILER.count('vtx_resident', count)
+                return lo, lo + load_amount
+
+        return None
+
+    def _reindex(self, triangles):
+        # Keep only vertices used by 'triangles' numbered in the order they are first used
+        vertices_replaced = self._vertices
+        shuffle_vertices_old2new = {}
+        shuffle_vertices_curr = 0
+        self._triangles = []
+        self._vertices = []
+        for tri in triangles:
+            for vtx in tri:
+                if vtx not in shuffle_vertices_old2new:
+                    shuffle_vertices_old2new[vtx] = shuffle_vertices_curr
+                    self._vertices.append(vertices_replaced[vtx])
+                    shuffle_vertices_curr += 1
+            self._triangles.append(tuple(shuffle_vertices_old2new[vtx] for vtx in tri))
+
+    def _filter_vertices(self, vtx_filter):
+        # Same as _reindex() after dropping triangles made of only filtered out vertices, done with array operations
+        import numpy as np
+
+        tris = np.array(self._triangles, dtype=np.int32).reshape(-1, 3)
+        kept = tris[~vtx_filter.mask(self._vertices)[tris].all(axis=1)]
+        PROFILER.count('vtx_filter_dropped', len(tris) - len(kept))
+        if len(kept) == len(tris):
+            return
+
+        # Vertices in the order they are first used
+        used, first_use = np.unique(kept.ravel(), return_index=True)
+        order = used[np.argsort(first_use)]
+        remap = np.empty(len(self._vertices), dtype=np.int32)
+        remap[order] = np.arange(len(order), dtype=np.int32)
+        self._vertices = [ self._vertices[vtx] for vtx in order.tolist() ]
+        self._triangles = list(map(tuple, remap[kept].tolist()))
+
+    def _weld(self):
+        # Returns the triangles with near duplicate vertices merged into the first of them if any got merged.
+        # Positions are hashed to a grid of WELD_POS_TOLERANCE sized cells so only the 27 cells around a vertex
+        # are searched for its match.
+        PROFILER.count('weld_vertices', len(self._vertices))
+        cell_size = WELD_POS_TOLERANCE + 1
+        cells = {}
+        remap = []
+        for idx, record in enumerate(self._vertices):
+            x, y, z, flag, u, v, *color = VTX_STRUCT.unpack(record)
+            cell = (x // cell_size, y // cell_size, z // cell_size)
+            match = None
+            for dx in (-1, 0, 1):
+                for dy in (-1, 0, 1):
+                    for dz in (-1, 0, 1):
+                        for other in cells.get((cell[0] + dx, cell[1] + dy, cell[2] + dz), ()):
+                            ox, oy, oz, oflag, ou, ov, *ocolor = VTX_STRUCT.unpack(self._vertices[other])
+                            if oflag != flag or max(abs(x - ox), abs(y - oy), abs(z - oz)) > WELD_POS_TOLERANCE:
+                                continue
+                            if max(abs(u - ou), abs(v - ov)) > WELD_UV_TOLERANCE:
+                                continue
+                            if max(abs(c - oc) for c, oc in zip(color, ocolor)) > WELD_COLOR_TOLERANCE:
+                                continue
+                            if match is None or other < match:
+                                match = other
+
+            if match is None:
+                cells.setdefault(cell, []).append(idx)
+                remap.append(idx)
+            else:
+                remap.append(match)
+
+        merged = sum(1 for idx, match in enumerate(remap) if idx != match)
+        if not merged:
+            return None
+
+        PROFILER.count('weld_merged', merged)
+        triangles = []
+        triangles_lookup = set()
+        for tri in self._triangles:
+            tri = tuple(remap[vtx] for vtx in tri)
+            if self._tri_trivial(tri):
+                continue
+            tri = self._tri_normalize(tri)
+            if tri in triangles_lookup:
+                continue
+            triangles.append(tri)
+            triangles_lookup.add(tri)
+        return triangles
+
+    def _retriangulate(self):
+        # Returns the new triangles if any flat region got cheaper. Regions grow over edges shared by exactly
+        # two triangles facing the same way within RETRI_TOLERANCE of the plane of the first triangle.
+        import numpy as np
+
+        vtx_values = self._vtx_values()
+        poss = np.array([ vtx.pos.as_list() for vtx in vtx_values ], dtype=np.float64)
+        attrs = np.array([ vtx.uv + vtx.color for vtx in vtx_values ], dtype=np.float64)
+        table = TriTable(self._triangles)
+        tris = np.array(table.rows, dtype=np.int32).reshape(-1, 3)
+        normals = np.cross(poss[tris[:, 1]] - poss[tris[:, 0]], poss[tris[:, 2]] - poss[tris[:, 0]])
+        lengths = np.linalg.norm(normals, axis=1)
+
+        visited = table.mask()
+        replaced = {}
+        for seed in range(len(table)):
+            if visited[seed] or not lengths[seed]:
+                continue
+
+            normal = normals[seed] / lengths[seed]
+            offset = poss[tris[seed, 0]] @ normal
+            visited[seed] = True
+            region = [ seed ]
+            for tri in region:
+                for a, b in TriKit._edges(table.rows[tri]):
+                    ntris = table.edge_tris.get((b, a), ())
+                    if len(ntris) != 1 or len(table.edge_tris[(a, b)]) != 1:
+                        continue
+                    ntri = ntris[0]
+                    if visited[ntri] or normals[ntri] @ normal <= 0 or np.abs(poss[tris[ntri]] @ normal - offset).max() > RETRI_TOLERANCE:
+                        continue
+                    visited[ntri] = True
+                    region.append(ntri)
+
+            new_tris = retriangulate_region(table, region, vtx_values, poss, attrs, normal)
+            if new_tris is not None:
+                PROFILER.count('retri_regions')
+                PROFILER.count('retri_tris_removed', len(region) - len(new_tris))
+                replaced[min(region)] = new_tris
+                for tri in region:
+                    replaced.setdefault(tri, [])
+
+        if not replaced:
+            return None
+
+        # New triangles of a region take the place of its first triangle
+        triangles = []
+        for tri_id, tri in enumerate(table.rows):
+            triangles.extend(replaced.get(tri_id, [ tri ]))
+        return triangles
+
+    def _load_partitioned(self, table):
+        # Region growing: a cluster starts from the triangle sharing the most vertices with the previous cluster
+        # so Step 2 can pin them, then takes the frontier triangle needing the fewest new vertices until the buffer
+        # is full. Among equals the vertices of the previous cluster are preferred, then the source order.
+        rendered = table.mask()
+        rendered_count = 0
+        next_unrendered = 0
+        prev_vertices = {}
+        while rendered_count < len(table):
+            loaded_vertices = {}
+            rendered_triangles = []
+            rendered_ids = []
+
+            seed = None
+            seed_shared = 0
+            for vtx in prev_vertices:
+                for i in table.vtx_tris[vtx]:
+                    if rendered[i]:
+                        continue
+                    shared = sum(1 for tri_vtx in table.rows[i] if tri_vtx in prev_vertices)
+                    if shared > seed_shared or (shared == seed_shared and i < seed):
+                        seed = i
+                        seed_shared = shared
+
+            frontier = []
+            def push(i):
+                tri = table.rows[i]
+                new = [ vtx for vtx in tri if vtx not in loaded_vertices ]
+                heapq.heappush(frontier, (len(new), -sum(1 for vtx in new if vtx in prev_vertices), i))
+
+            while True:
+                if not frontier:
+                    if seed is None:
+                        # Frontier ran dry, continue with a disconnected part if it still fits
+                        while next_unrendered < len(table) and rendered[next_unrendered]:
+                            next_unrendered += 1
+                        if next_unrendered == len(table) or len(loaded_vertices) > VTX_BUF_SIZE - 3:
+                            break
+                        seed = next_unrendered
+                    push(seed)
+                    seed = None
+
+                new_count, _, i = heapq.heappop(frontier)
+                if rendered[i]:
+                    continue
+                tri = table.rows[i]
+                new = [ vtx for vtx in tri if vtx not in loaded_vertices ]
+                if len(new) != new_count:
+                    # Stale entry, some of its vertices got loaded since it was pushed
+                    push(i)
+                    continue
+                if len(loaded_vertices) + new_count > VTX_BUF_SIZE:
+                    # Nothing left in the frontier needs less vertices
+                    break
+
+                for vtx in new:
+                    loaded_vertices[vtx] = len(loaded_vertices)
+                    for j in table.vtx_tris[vtx]:
+                        if not rendered[j]:
+                            push(j)
+                rendered[i] = True
+                rendered_count += 1
+                rendered_triangles.append(tuple(loaded_vertices[vtx] for vtx in tri))
+                rendered_ids.append(i)
+
+            PROFILER.count('partitions')
+            prev_vertices = loaded_vertices
+            yield rendered_triangles, rendered_ids, loaded_vertices
+
+    def compile(self, have_tile, vtx_filter, resident=None):
+        # 'resident' is the buffer left by the previous chunk, location to vertex record
+        assert self._base_vertices_model_entry is not None, "compile() called twice"
         assert not self._base_vertices_model_entry.used
         self._base_vertices_model_entry.used = True
         draws = []
         vtx_entry = self._base_vertices_model_entry
 
-        vtx_values = [ Vtx(vtx) for vtx in self._vertices ]
-
-        triangles_altered = False
-        if vtx_filter:
-            vtx_skipped = [ vtx_filter(vtx) for vtx in vtx_values ]
-            old_tri_len = len(self._triangles)
-            triangles = [ tri for tri in self._triangles if any(not vtx_skipped[vtx] for vtx in tri) ]
-            triangles_altered = old_tri_len != len(triangles)
-
-        if triangles_altered:
-            vertices_replaced = self._vertices
-            shuffle_vertices_old2new = {}
-            shuffle_vertices_curr = 0   
-            self._triangles = []         
-            self._vertices = []
-            for tri in triangles:
-                for vtx in tri:
-                    if vtx not in shuffle_vertices_old2new:
-                        shuffle_vertices_old2new[vtx] = shuffle_vertices_curr
-                        self._vertices.append(vertices_replaced[vtx])
-                        shuffle_vertices_curr += 1
-                self._triangles.append(tuple(shuffle_vertices_old2new[vtx] for vtx in tri))
-
-            vtx_values = [ Vtx(vtx) for vtx in self._vertices ]
-
-        if False and not have_tile and vtx_values and len(self._triangles) > 5:
-            np_vtx_poss = np.array([vtx.pos.as_list() for vtx in vtx_values])
-            try:
-                np_vtx_poss_hull_indices = list(ConvexHull(np_vtx_poss).vertices)
-            except:
-                try:
-                    np_vtx_poss_hull_indices = list(ConvexHull(np_vtx_poss, qhull_options='QJ').vertices)
-                except:
-                    np_vtx_poss_hull_indices = []
-
-            if len(np_vtx_poss_hull_indices) > VTX_BUF_SIZE:
-                np_vtx_poss_hull_indices = []
-        else:
-            np_vtx_poss_hull_indices = []
+        if vtx_filter and self._triangles:
+            with PROFILER.phase('vtx_filter'):
+                self._filter_vertices(vtx_filter)
+
+        if WELD_POS_TOLERANCE is not None:
+            with PROFILER.phase('weld'):
+                triangles = self._weld()
+            if triangles is not None:
+                self._reindex(triangles)
+
+        if RETRI_TOLERANCE is not None:
+            with PROFILER.phase('retriangulate'):
+                triangles = self._retriangulate()
+            if triangles is not None:
+                self._reindex(triangles)
+
+        if TRI_REORDER and len(self._vertices) > VTX_BUF_SIZE:
+            # Vertices are renumbered in the order of first use too so ties in the loader follow the new order
+            with PROFILER.phase('reorder'):
+                self._reindex(TriKit.reorder_for_cache(self._triangles, VTX_BUF_SIZE - 3))
+
+        # Culling volume is either the hull vertices pinned to the start of the first render pass or bounding box corners
+        # stored in front of the chunk vertices and loaded on their own
+        np_vtx_poss_hull_indices = []
+        cull_records = []
+        if CULL_MODE != 'off' and self.cullable and not have_tile and len(self._triangles) >= CULL_MIN_TRIANGLES:
+            np_vtx_poss_hull_indices, cull_records = cull_volume(self._vtx_values())
+
+        PROFILER.count('chunks')
+        PROFILER.push('vtx_load')
 
         # Step 1: Generate render passes for each vertex set
         render_passes = []
+        adjacency = None
+        if HAS_EX3_COMMANDS:
+            with PROFILER.phase('stripify'):
+                adjacency = StripAdjacency(self._triangles)
         culling_pinned_vertices = np_vtx_poss_hull_indices
 
         # For a grand majority of cases "just draw" will be good enough - that's when all vertices fit in the buffer
@@ -939,14 +1875,19 @@ class ModelMeshEntry(TriKit):
                 if i not in np_vtx_poss_hull_indices:
                     loaded_vertices[i] = len(loaded_vertices)
 
-            render_passes.append(self._make_render_pass([ tuple([ loaded_vertices[vtx] for vtx in tri ]) for tri in self._triangles ], loaded_vertices))
+            render_passes.append(self._make_render_pass([ tuple([ loaded_vertices[vtx] for vtx in tri ]) for tri in self._triangles ], range(len(self._triangles)), loaded_vertices, adjacency))
+        elif VTX_LOADER == 'partition' and not np_vtx_poss_hull_indices:
+            for rendered_triangles, rendered_ids, loaded_vertices in self._load_partitioned(TriTable(self._triangles)):
+                render_passes.append(self._make_render_pass(rendered_triangles, rendered_ids, loaded_vertices, adjacency))
         else:
             # This is a primitive greedy algorithm for loading vertices with weights
             preload_vertices = np_vtx_poss_hull_indices
-            total_pricer = UsagePricer(self._triangles)
+            table = TriTable(self._triangles)
+            total_pricer = UsagePricer(table, range(len(table)))
             while not total_pricer.completed():
                 loaded_vertices = {}
                 rendered_triangles = []
+                rendered_ids = []
 
                 precandidate_vtxs = None
                 precandidate_tris = None
@@ -956,11 +1897,12 @@ class ModelMeshEntry(TriKit):
                     for i in preload_vertices:
                         assert i not in loaded_vertices, "preload vertices must not contain duplicates"
                         loaded_vertices[i] = len(loaded_vertices)
-                    for tri in self._triangles:
+                    for tri_id, tri in enumerate(table.rows):
                         loaded_tri = [ loaded_vertices.get(vtx) for vtx in tri ]
                         if None not in loaded_tri:
                             rendered_triangles.append(tuple(loaded_tri))
-                            total_pricer.remove(tri)
+                            rendered_ids.append(tri_id)
+                            total_pricer.remove(tri_id)
                         else:
                             want = False
                             for i, vtx in enumerate(loaded_tri):
@@ -978,11 +1920,11 @@ class ModelMeshEntry(TriKit):
                     preload_vertices = None
 
                 while not total_pricer.completed() and len(loaded_vertices) < VTX_BUF_SIZE - 3:
+                    # Candidate pricer is kept up to date below instead of being recreated for every loaded vertex
                     if precandidate_vtxs:
                         log_debug(f"precandidate_vtxs: {precandidate_vtxs}, precandidate_tris: {precandidate_tris}")
                         candidate_vtxs = precandidate_vtxs
-                        candidate_tris = precandidate_tris
-                        candidate_to_load_pricer = UsagePricer(candidate_tris, loaded_vertices, rendered_triangles, set(loaded_vertices.keys()))
+                        candidate_to_load_pricer = UsagePricer(table, precandidate_tris, loaded_vertices, rendered_triangles)
                         highest_usage_vtx = candidate_to_load_pricer.highest_usage()
                         assert highest_usage_vtx not in loaded_vertices, "highest_usage_vtx must not be loaded"
                         precandidate_tris = None
@@ -991,23 +1933,25 @@ class ModelMeshEntry(TriKit):
                         highest_usage_vtx = total_pricer.highest_usage()
                         assert highest_usage_vtx not in loaded_vertices, "highest_usage_vtx must not be loaded"
                         candidate_vtxs = set()
-                        candidate_tris = set()
+                        candidate_to_load_pricer = UsagePricer(table, (), loaded_vertices, rendered_triangles)
 
                     loaded_vertices[highest_usage_vtx] = len(loaded_vertices)
-                    banned_vertices = set(loaded_vertices.keys())
                     log_debug("")
                     while True:
                         log_debug(f"{loaded_vertices}")
-                        banned_vertices.add(highest_usage_vtx)
-                        highest_usage_vtx_triangles = list(total_pricer.vtx_to_tris(highest_usage_vtx))
-                        for tri in highest_usage_vtx_triangles:
+                        candidate_to_load_pricer.load(highest_usage_vtx)
+                        for tri_id in total_pricer.vtx_to_tris(highest_usage_vtx):
+                            tri = table.rows[tri_id]
                             loaded_tri = [ loaded_vertices.get(vtx) for vtx in tri ]
                             log_debug(f"{tri} -> {loaded_tri}")
                             if not None in loaded_tri:
                                 log_debug(f"render {tri} as {loaded_tri}")
-                                rendered_triangles.append(tuple(loaded_tri))
-                                candidate_tris.remove(tri)
-                                total_pricer.remove(tri)
+                                loaded_tri = tuple(loaded_tri)
+                                rendered_triangles.append(loaded_tri)
+                                rendered_ids.append(tri_id)
+                                candidate_to_load_pricer.remove(tri_id)
+                                candidate_to_load_pricer.render(loaded_tri)
+                                total_pricer.remove(tri_id)
                                 continue
                         
                             for i, loaded_idx in enumerate(loaded_tri):
@@ -1021,9 +1965,8 @@ class ModelMeshEntry(TriKit):
                                 candidate_vtxs.add(candidate_vtx)
                                 candidate_vtx_tris = total_pricer.vtx_to_tris(candidate_vtx)
                                 for candidate_tri in candidate_vtx_tris:
-                                    candidate_tris.add(candidate_tri)
+                                    candidate_to_load_pricer.add(candidate_tri)
 
-                        candidate_to_load_pricer = UsagePricer(candidate_tris, loaded_vertices, rendered_triangles, banned_vertices)
                         if candidate_to_load_pricer.completed() or len(loaded_vertices) == VTX_BUF_SIZE:
                             break
 
@@ -1031,20 +1974,56 @@ class ModelMeshEntry(TriKit):
                         assert highest_usage_vtx not in loaded_vertices, "highest_usage_vtx must not be loaded"
                         loaded_vertices[highest_usage_vtx] = len(loaded_vertices)
 
-                render_passes.append(self._make_render_pass(rendered_triangles, loaded_vertices))
+                render_passes.append(self._make_render_pass(rendered_triangles, rendered_ids, loaded_vertices, adjacency))
 
-        # Step 2: Find common vertices across render passes and pin them to the left side of the buffer
-        render_pass_vtx_load_offsets = []
+        PROFILER.count('render_passes', len(render_passes))
+        PROFILER.switch('pinning')
+
+        # Step 1.5: Keep the vertices still in the buffer where they are for the first render pass
+        first_vtx_load_range = None
+        if resident and not np_vtx_poss_hull_indices and not cull_records:
+            first_vtx_load_range = self._pin_resident(render_passes[0], resident)
+
+        # Step 2: Find common vertices across render passes and pin them to the left side of the buffer.
+        # Common vertices that cannot stay on the left are pinned to the right end of the previous pass load.
+        # Each render pass loads the vertices in the range from 'lo' to 'hi' of the buffer.
+        render_pass_vtx_load_ranges = []
         prev_render_pass = None
+        # Previous pass has vertices at locations it did not choose so it must not be shuffled outside of its load range
+        prev_pinned_right = first_vtx_load_range is not None
         pinned_vertices_left = culling_pinned_vertices
         altered_render_passes = [] if not culling_pinned_vertices else [render_passes[0]]
+
+        def pin_right(render_pass, shared_vertices, lim):
+            # Vertices loaded by the previous pass can be moved to the end of its load and kept there in the current pass
+            # as long as the vertices the current pass loads after the first 'lim' fit before them
+            prev_lo, prev_hi = render_pass_vtx_load_ranges[-1]
+            shared_vertices = [ vtx for vtx in shared_vertices if prev_lo <= prev_render_pass.vertices[vtx] < prev_hi ]
+            if not shared_vertices or len(render_pass.vertices) > prev_hi:
+                return None
+
+            shuffle = make_shuffle_pinning_shared_right(prev_render_pass.vertices, shared_vertices, prev_lo, prev_hi)
+            log_debug(f"apply right pinning shuffle {shuffle} to previous pass")
+            apply_shuffle(prev_render_pass, shuffle)
+            shuffle = make_shuffle_pinned_right(render_pass.vertices, { vtx: prev_render_pass.vertices[vtx] for vtx in shared_vertices }, lim)
+            log_debug(f"apply right pinned shuffle {shuffle}")
+            apply_shuffle(render_pass, shuffle)
+            PROFILER.count('pinned_right', len(shared_vertices))
+            return lim, len(render_pass.vertices) - len(shared_vertices)
+
         for i, render_pass in enumerate(render_passes):
             curr_vertices = set(render_pass.vertices.keys())
             log_debug(f"render pass {i} -> {curr_vertices}")
+            vtx_load_range = None
+            pinned_right = False
             if prev_render_pass:
                 prev_vertices = prev_render_pass.vertices
                 common_vertices = set(prev_vertices.keys()).intersection(curr_vertices)
-                if common_vertices:
+                if common_vertices and not pinned_vertices_left and prev_pinned_right:
+                    # Previous pass has its own right pinned vertices that cannot be moved to the left
+                    vtx_load_range = pin_right(render_pass, sorted(common_vertices), 0)
+                    pinned_right = vtx_load_range is not None
+                elif common_vertices:
                     log_debug(f"common vertices {common_vertices}, length {len(common_vertices)}")
                     if not pinned_vertices_left:
                         # Perform the first shuffling and pin the common vertices on the left vbo
@@ -1090,48 +2069,65 @@ class ModelMeshEntry(TriKit):
                             # There is nothing else left to repin, drop left buffer
                             pinned_vertices_left = None
                             altered_render_passes = []
-                        # ...and potentially pin the right buffer to the right side of the buffer - todo!
+
+                        # ...and pin the rest to the right side of the buffer
+                        if unpinned_vertices_right:
+                            log_debug(f"unpinned vertices right {unpinned_vertices_right}")
+                            vtx_load_range = pin_right(render_pass, sorted(unpinned_vertices_right), len(pinned_vertices_left) if pinned_vertices_left else 0)
+                            pinned_right = vtx_load_range is not None
                 else:
                     pinned_vertices_left = None
                     altered_render_passes = []
 
-            render_pass_vtx_load_offsets.append(0 if not pinned_vertices_left else len(pinned_vertices_left))
+            if not vtx_load_range and 0 == i and first_vtx_load_range:
+                # Resident vertices sit outside of the load range so the next pass must not shuffle this one
+                vtx_load_range = first_vtx_load_range
+                pinned_right = True
+            if not vtx_load_range:
+                vtx_load_range = (0 if not pinned_vertices_left else len(pinned_vertices_left), len(render_pass.vertices))
+            render_pass_vtx_load_ranges.append(vtx_load_range)
             prev_render_pass = render_pass
+            prev_pinned_right = pinned_right
+
+        PROFILER.switch('emit')
 
         # Step 3: Generate the display lists rendering the render passes
-        vtx_entry.vertices = []
-        start_offset = 0
+        vertices = list(cull_records)
+        start_offset = len(cull_records)
+        if cull_records:
+            draws.append(f"\tgsSPVertex({vtx_entry.name}, {len(cull_records)}, 0),\n")
+            draws.append(f"\tgsSPCullDisplayList(0, {len(cull_records) - 1}),\n")
         first = True
-        for render_pass, vtx_load_offset in zip(render_passes, render_pass_vtx_load_offsets):
+        for render_pass, (vtx_load_offset, vtx_load_end) in zip(render_passes, render_pass_vtx_load_ranges):
             cur_vtx_start_offset = start_offset
             add_cull_with_len = 0
-            if first:
+            if first and np_vtx_poss_hull_indices:
                 add_cull_with_len = vtx_load_offset
                 vtx_load_offset = 0
-                first = False
+            first = False
 
             log_debug(f"render pass out {render_pass.vertices} at {vtx_load_offset}")
-            cur_vtx_load_amount = len(render_pass.vertices) - vtx_load_offset
+            cur_vtx_load_amount = vtx_load_end - vtx_load_offset
 
             for _ in range(cur_vtx_load_amount):
-                vtx_entry.vertices.append(None)
+                vertices.append(None)
             for vtx in render_pass.vertices:
-                if render_pass.vertices[vtx] < vtx_load_offset:
+                if render_pass.vertices[vtx] < vtx_load_offset or render_pass.vertices[vtx] >= vtx_load_end:
                     continue
 
                 glo = start_offset + render_pass.vertices[vtx] - vtx_load_offset
-                assert not vtx_entry.vertices[glo], f"vtx_entry is reused at {glo} for {vtx}"
-                vtx_entry.vertices[glo] = self._vertices[vtx]
+                assert not vertices[glo], f"vtx_entry is reused at {glo} for {vtx}"
+                vertices[glo] = self._vertices[vtx]
 
-            assert None not in vtx_entry.vertices[start_offset:start_offset + cur_vtx_load_amount], "vtx_entry is not filled correctly"
+            assert None not in vertices[start_offset:start_offset + cur_vtx_load_amount], "vtx_entry is not filled correctly"
             start_offset += cur_vtx_load_amount
 
             if add_cull_with_len:
                 draws.append(f"\tgsSPVertex({vtx_entry.name}, {add_cull_with_len}, 0),\n")
-                draws.append(f"\tgsSPCullDisplayList(0, {add_cull_with_len}),\n")
+                draws.append(f"\tgsSPCullDisplayList(0, {add_cull_with_len - 1}),\n")
 
             if cur_vtx_load_amount:
-                if 1 == len(render_passes) and 0 == add_cull_with_len:
+                if 1 == len(render_passes) and 0 == add_cull_with_len and not cull_records:
                     draws.append(f"\tgsSPVertex({vtx_entry.name}, {cur_vtx_load_amount}, {vtx_load_offset}),\n")
                 else:
                     if 0 == add_cull_with_len:
@@ -1139,45 +2135,17 @@ class ModelMeshEntry(TriKit):
                     elif cur_vtx_load_amount != add_cull_with_len:
                         draws.append(f"\tgsSPVertex({vtx_entry.name} + {cur_vtx_start_offset} + {add_cull_with_len}, {cur_vtx_load_amount} - {add_cull_with_len}, {vtx_load_offset} + {add_cull_with_len}),\n")
 
-            triangles = deque(render_pass.triangles)
-            while triangles:
-                if HAS_TRI3:
-                    if 1 == len(triangles):
-                        tri = triangles.popleft()
-                        draws.append(f"\tgsSP1Triangle({tri[0]}, {tri[1]}, {tri[2]}, 0),\n")
-                    elif 2 == len(triangles):
-                        tri0 = triangles.popleft()
-                        tri1 = triangles.popleft()
-                        draws.append(f"\tgsSP2Triangles({tri0[0]}, {tri0[1]}, {tri0[2]}, 0, {tri1[0]}, {tri1[1]}, {tri1[2]}, 0),\n")
-                    elif 4 == len(triangles):
-                        # 4 triangles is better presented as 2xTRI2 commands - same amount of commands but less RSP work
-                        tri0 = triangles.popleft()
-                        tri1 = triangles.popleft()
-                        tri2 = triangles.popleft()
-                        tri3 = triangles.popleft()
-                        draws.append(f"\tgsSP2Triangles({tri0[0]}, {tri0[1]}, {tri0[2]}, 0, {tri1[0]}, {tri1[1]}, {tri1[2]}, 0),\n")
-                        draws.append(f"\tgsSP2Triangles({tri2[0]}, {tri2[1]}, {tri2[2]}, 0, {tri3[0]}, {tri3[1]}, {tri3[2]}, 0),\n")
-                    else:
-                        tri0 = triangles.popleft()
-                        tri1 = triangles.popleft()
-                        tri2 = triangles.popleft()
-                        draws.append(f"\tgsSP3Triangles({tri0[0]}, {tri0[1]}, {tri0[2]}, {tri1[0]}, {tri1[1]}, {tri1[2]}, {tri2[0]}, {tri2[1]}, {tri2[2]}),\n")
-                else:
-                    if 1 == len(triangles):
-                        tri = triangles.popleft()
-                        draws.append(f"\tgsSP1Triangle({tri[0]}, {tri[1]}, {tri[2]}, 0),\n")
-                    else:
-                        tri0 = triangles.popleft()
-                        tri1 = triangles.popleft()
-                        draws.append(f"\tgsSP2Triangles({tri0[0]}, {tri0[1]}, {tri0[2]}, 0, {tri1[0]}, {tri1[1]}, {tri1[2]}, 0),\n")
-
-            for snake in render_pass.snakes:
-                draws.extend(snake.stringify_x())
+            draws.extend(emit_draws(render_pass.triangles, render_pass.snakes))
 
-        vtx_entry.vertices.append("};\n")
+        vtx_entry.records = b''.join(vertices)
 
         #dl_entry.data.append(f"\tgsSPEndDisplayListHint(4),\n")
         #dl_entry.data.append("};\n")
+        PROFILER.count('vtx_loads', sum(1 for draw in draws if 'gsSPVertex' in draw))
+        PROFILER.count('vtx_loaded', len(vtx_entry))
+        PROFILER.pop()
+        self._record_mesh(draws, vtx_entry)
+
         # this function is not reentrant so make sure we will crash next time we this
         self._base_vertices_model_entry = None
         return draws, vtx_entry
@@ -1201,39 +2169,51 @@ class Model:
     def erase(self, num):
         self.entries[num] = None
 
-def peek_line(f):
-    pos = f.tell()
-    line = f.readline()
-    f.seek(pos)
-    return line
-
 def load_model(model_path):
+    with PROFILER.phase('parse'):
+        return _load_model(model_path)
+
+def _load_model(model_path):
     model = Model()
     curr_entry: ModelEntry = None
+    # Reading everything at once is a lot faster than going line by line
     with open(model_path, "r") as f_model:
-        while True:
-            line = f_model.readline()
-            if not line:
-                break
-            if line.startswith('#include'):
-                continue
-            if line.startswith('//'):
-                continue
-
-            if line == '\n':
-                curr_entry = None
-                continue
-            else:
-                if not curr_entry:
-                    assert '] = {' in line
-                    if 'Vtx' in line:
-                        curr_entry = ModelVtxEntry(line)
-                    else:
-                        curr_entry = ModelRawEntry(line)
+        lines = f_model.readlines()
 
-                    model.add(curr_entry)
+    # Only blank lines, includes and comments need special care - everything in between is copied as a slice
+    marks = [ i for i, line in enumerate(lines) if line[0] in '\n#/' ] + [ len(lines) ]
+    start = 0
+    for mark in marks:
+        if start < mark:
+            if curr_entry is None:
+                line = lines[start]
+                assert '] = {' in line
+                if 'Vtx' in line:
+                    curr_entry = ModelVtxEntry(line)
                 else:
-                    curr_entry.add(line)
+                    curr_entry = ModelRawEntry(line)
+
+                model.add(curr_entry)
+                start += 1
+
+            curr_entry.extend(lines[start:mark])
+
+        start = mark + 1
+        if mark == len(lines):
+            break
+
+        line = lines[mark]
+        if line.startswith('#include'):
+            continue
+        if line.startswith('//'):
+            continue
+
+        if line == '\n':
+            curr_entry = None
+            continue
+
+        # Not a special line after all
+        start = mark
 
     return model
 
@@ -1242,19 +2222,457 @@ class ModelMeshEntryList(ModelEntry):
         super().__init__(line)
         self.data = [line]
         self.opvtxs = []
+        self.cullable = False
+        # Sub-lists made by split_list(), written in front of this one
+        self.parts = []
+        self.part = False
 
-def _is_tri(line):
-    return 'gsSP2Triangles' in line or 'gsSP1Triangle' in line
+SUB_DL_RE = re.compile(r'\s*gsSP(?:DisplayList|BranchList)\(\s*(\w+)\s*\)')
 
-def _is_draw(line, nline):
-    if _is_tri(line):
+# Commands that do not touch the vertex buffer or the way vertices are loaded
+RESIDENT_SAFE_RE = re.compile(r'\s*gsDP\w*\(')
+
+# Commands that can be skipped together with a culled chunk
+CULL_SAFE_TAIL_RE = re.compile(r'\s*(gsDPPipeSync\(|gsSPEndDisplayList\(|};|$)')
+
+def _is_tri(draw):
+    return draw and draw[0] != 'gsSPVertex'
+
+def _is_draw(draw, ndraw):
+    if _is_tri(draw):
         return True
-    if 'gsSPVertex' in line:
-        return _is_tri(nline)
+    if draw and draw[0] == 'gsSPVertex':
+        return _is_tri(ndraw)
 
     return False
 
-def optimize_model(model, vtx_filter=None):
+# Globals that affect compile() and must be the same in worker processes
+def _compile_settings():
+    return {
+        'HAS_EX3_COMMANDS': HAS_EX3_COMMANDS,
+        'HAS_TRI3': HAS_TRI3,
+        'VTX_BUF_SIZE': VTX_BUF_SIZE,
+        'STRIP_ALGO': STRIP_ALGO,
+        'STRIP_LOOKAHEAD': STRIP_LOOKAHEAD,
+        'WALK_LIMIT': WALK_LIMIT,
+        'VTX_LOADER': VTX_LOADER,
+        'TRI_REORDER': TRI_REORDER,
+        'CULL_MODE': CULL_MODE,
+        'CULL_HULL_MAX_VERTICES': CULL_HULL_MAX_VERTICES,
+        'CULL_MIN_TRIANGLES': CULL_MIN_TRIANGLES,
+        'CULL_MAX_EXTENT': CULL_MAX_EXTENT,
+        'SHARE_VTX_BUFFER': SHARE_VTX_BUFFER,
+        'SPLIT_COUNT': SPLIT_COUNT,
+        'SPLIT_MIN_TRIANGLES': SPLIT_MIN_TRIANGLES,
+        'SPLIT_CANDIDATES': SPLIT_CANDIDATES,
+        'SPLIT_DUP_COST': SPLIT_DUP_COST,
+        'SPLIT_STATE_COST': SPLIT_STATE_COST,
+        'WELD_POS_TOLERANCE': WELD_POS_TOLERANCE,
+        'WELD_UV_TOLERANCE': WELD_UV_TOLERANCE,
+        'WELD_COLOR_TOLERANCE': WELD_COLOR_TOLERANCE,
+        'RETRI_TOLERANCE': RETRI_TOLERANCE,
+        'RETRI_ATTR_TOLERANCE': RETRI_ATTR_TOLERANCE,
+        'EMIT_COSTS': EMIT_COSTS,
+        'VERBOSE': VERBOSE,
+    }
+
+def _compile_worker_init(settings, vtx_filter):
+    globals().update(settings)
+    global _worker_vtx_filter
+    _worker_vtx_filter = vtx_filter
+
+def _compile_worker(chain):
+    PROFILER.reset()
+    results = _compile_chain(chain, _worker_vtx_filter)
+    return results, PROFILER.snapshot()
+
+def _int_expr(expr):
+    # Sums like '12 + 3' or '40 - 3' that compile() writes in gsSPVertex arguments
+    return sum(int(term.replace(' ', '')) for term in re.findall(r'[+-]?\s*\d+', expr))
+
+def buffer_after(draws, records, resident=None):
+    # Vertex buffer, location to vertex record, after running the gsSPVertex commands of compile() output
+    buffer = dict(resident) if resident else {}
+    for draw in draws:
+        parsed = parse_draw(draw)
+        if not parsed or parsed[0] != 'gsSPVertex':
+            continue
+        vtx_arg, amount, dst = parsed[1]
+        offset = _int_expr(vtx_arg.split('+', 1)[1]) if '+' in vtx_arg else 0
+        dst = _int_expr(dst)
+        for i in range(_int_expr(amount)):
+            buffer[dst + i] = records[(offset + i) * VTX_STRUCT.size:(offset + i + 1) * VTX_STRUCT.size]
+    return buffer
+
+def _compile_chain(chain, vtx_filter):
+    # Chunks of a chain are compiled in order, each one starting with the buffer the previous one left
+    results = []
+    resident = None
+    for entry, have_tile in chain:
+        draws, vtx_entry = entry.compile(have_tile, vtx_filter, resident)
+        results.append((draws, vtx_entry))
+        resident = buffer_after(draws, vtx_entry.records, resident)
+    return results
+
+def _make_chains(tasks):
+    chains = []
+    for task in tasks:
+        if chains and task[0].shares_buffer:
+            chains[-1].append(task)
+        else:
+            chains.append([ task ])
+    return chains
+
+def _source_digest():
+    global _source_digest_value
+    if not _source_digest_value:
+        with open(__file__, 'rb') as f:
+            _source_digest_value = hashlib.sha256(f.read()).digest()
+    return _source_digest_value
+
+_source_digest_value = None
+
+def _filter_key(vtx_filter):
+    if not vtx_filter:
+        return None
+    return vtx_filter.key()
+
+# Vertex array names depend on where the chunk is so they are stored as this token in the cache
+CACHE_NAME_TOKEN = '@VTX@'
+
+class CompileCache:
+    # Content-addressed storage of compile() results, one json file per chunk.
+    # Hits refresh the file mtime so trim() can evict the least recently used entries.
+    def __init__(self, path, max_size):
+        self._path = path
+        self._max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        os.makedirs(path, exist_ok=True)
+
+    def _entry_path(self, key):
+        return os.path.join(self._path, f"{key}.json")
+
+    # Values are the results of every chunk of a chain
+    def get(self, key):
+        path = self._entry_path(key)
+        try:
+            with open(path, "r") as f:
+                value = json.load(f)
+        except (OSError, ValueError):
+            self.misses += 1
+            PROFILER.count('cache_misses')
+            return None
+
+        os.utime(path)
+        self.hits += 1
+        PROFILER.count('cache_hits')
+        return [ (chunk['draws'], bytes.fromhex(chunk['records'])) for chunk in value ]
+
+    def put(self, key, results):
+        value = [ { 'draws': [ draw.replace(name, CACHE_NAME_TOKEN) for draw in draws ], 'records': records.hex() } for name, draws, records in results ]
+        # Write to a temporary file first so concurrent runs never see a partial entry
+        path = self._entry_path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(value, f)
+        os.replace(tmp_path, path)
+
+    def trim(self):
+        entries = []
+        total_size = 0
+        for dir_entry in os.scandir(self._path):
+            if not dir_entry.name.endswith('.json'):
+                continue
+            stat = dir_entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, dir_entry.path))
+            total_size += stat.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total_size <= self._max_size:
+                break
+            os.remove(path)
+            total_size -= size
+            self.evicted += 1
+
+    def report(self):
+        return f"cache: {self.hits} hits, {self.misses} misses, {self.evicted} evicted"
+
+def _compile_entries_cached(tasks, vtx_filter, jobs, cache):
+    chains = _make_chains(tasks)
+    if not cache:
+        return [ result for results in _compile_entries(chains, vtx_filter, jobs) for result in results ]
+
+    results = [ None ] * len(chains)
+    keys = [ None ] * len(chains)
+    missed = []
+    for i, chain in enumerate(chains):
+        # The buffer a chunk starts with comes from the chunks before it in the chain so the chain is cached as a whole
+        keys[i] = hashlib.sha256(''.join(entry.cache_key(have_tile, vtx_filter) for entry, have_tile in chain).encode()).hexdigest()
+        cached = cache.get(keys[i])
+        if cached:
+            results[i] = [ entry.compile_from_cache(*chunk) for (entry, _), chunk in zip(chain, cached) ]
+        else:
+            missed.append(i)
+
+    names = [ [ entry.vtx_entry_name() for entry, _ in chains[i] ] for i in missed ]
+    compiled = _compile_entries([ chains[i] for i in missed ], vtx_filter, jobs)
+    for i, chain_names, chain_results in zip(missed, names, compiled):
+        cache.put(keys[i], [ (name, draws, vtx_entry.records) for name, (draws, vtx_entry) in zip(chain_names, chain_results) ])
+        results[i] = chain_results
+
+    cache.trim()
+    return [ result for chain_results in results for result in chain_results ]
+
+def _compile_entries(chains, vtx_filter, jobs):
+    if jobs <= 1 or len(chains) <= 1:
+        return [ _compile_chain(chain, vtx_filter) for chain in chains ]
+
+    # Chains of mesh chunks are independent once their vertices are resolved so they can be compiled anywhere.
+    # 'map' returns results in submission order which keeps the output identical to the serial path.
+    for chain in chains:
+        for entry, _ in chain:
+            entry.detach()
+
+    chunksize = max(1, len(chains) // (jobs * 4))
+    results = []
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_compile_worker_init, initargs=(_compile_settings(), vtx_filter)) as executor:
+        for result, snapshot in executor.map(_compile_worker, chains, chunksize=chunksize):
+            PROFILER.merge(snapshot)
+            results.append(result)
+    return results
+
+def _mark_shared_chunks(data):
+    # Vertices are transformed and lit when loaded so only RDP commands may be between the chunks
+    prev_chunk_safe = False
+    for line in data[1:]:
+        if isinstance(line, ModelMeshEntry):
+            line.shares_buffer = prev_chunk_safe
+            prev_chunk_safe = True
+        elif line.strip() and not RESIDENT_SAFE_RE.match(line):
+            prev_chunk_safe = False
+
+def _half_area(lo, hi):
+    extent = hi - lo
+    return extent[..., 0] * extent[..., 1] + extent[..., 1] * extent[..., 2] + extent[..., 2] * extent[..., 0]
+
+def _best_split(centroids, tri_poss, tris, owners, state_costs):
+    # Mask of the triangles going to one side of the cheapest cut, None if the cell cannot be cut.
+    # 'owners' are the chunks of the triangles and 'state_costs' the state commands in front of every chunk.
+    import numpy as np
+
+    tri_lo = tri_poss.min(axis=1)
+    tri_hi = tri_poss.max(axis=1)
+    area = _half_area(tri_lo.min(axis=0), tri_hi.max(axis=0))
+    best = None
+    for axis in range(3):
+        order = np.argsort(centroids[:, axis], kind='stable')
+        # Bounds of the triangles before and after every position in 'order'
+        lo_before = np.minimum.accumulate(tri_lo[order])
+        hi_before = np.maximum.accumulate(tri_hi[order])
+        lo_after = np.minimum.accumulate(tri_lo[order][::-1])[::-1]
+        hi_after = np.maximum.accumulate(tri_hi[order][::-1])[::-1]
+        for k in range(1, SPLIT_CANDIDATES):
+            count = len(order) * k // SPLIT_CANDIDATES
+            sah = (_half_area(lo_before[count - 1], hi_before[count - 1]) * count
+                   + _half_area(lo_after[count], hi_after[count]) * (len(order) - count)) / area if area else len(order)
+            shared = np.intersect1d(np.unique(tris[order[:count]]), np.unique(tris[order[count:]]), assume_unique=True).size
+            shared_chunks = np.intersect1d(np.unique(owners[order[:count]]), np.unique(owners[order[count:]]), assume_unique=True)
+            cost = sah + SPLIT_DUP_COST * shared + SPLIT_STATE_COST * state_costs[shared_chunks].sum()
+            if best is None or cost < best[0]:
+                best = (cost, order[:count])
+
+    # Cutting only pays off when fewer triangles are expected to be drawn
+    if best is None or best[0] >= len(tris):
+        return None
+    mask = np.zeros(len(tris), dtype=bool)
+    mask[best[1]] = True
+    return mask
+
+def split_triangles(chunks, count, state_costs):
+    # Cells of a BVH over the triangle centroids of 'chunks', the biggest cell is cut until there are 'count' of them.
+    # 'state_costs' are the state commands in front of every chunk. For every cell the ids of its triangles in each chunk.
+    import numpy as np
+
+    vtx_offsets = np.cumsum([ 0 ] + [ len(chunk._vertices) for chunk in chunks ])
+    tri_offsets = np.cumsum([ 0 ] + [ len(chunk._triangles) for chunk in chunks ])
+    poss = np.frombuffer(b''.join(vertex for chunk in chunks for vertex in chunk._vertices), dtype=np.dtype('<i2')).reshape(-1, len(VTX_FIELDS))[:, :3]
+    tris = np.concatenate([ np.array(chunk._triangles, dtype=np.int64).reshape(-1, 3) + vtx_offsets[i] for i, chunk in enumerate(chunks) ])
+    owners = np.repeat(np.arange(len(chunks)), np.diff(tri_offsets))
+    tri_poss = poss[tris].astype(np.float64)
+    centroids = tri_poss.mean(axis=1)
+    state_costs = np.array(state_costs, dtype=np.float64)
+
+    cells = [ np.arange(len(tris)) ]
+    while len(cells) < count:
+        idx = max(range(len(cells)), key=lambda i: len(cells[i]))
+        cell = cells[idx]
+        if len(cell) < 2 * SPLIT_MIN_TRIANGLES:
+            break
+        mask = _best_split(centroids[cell], tri_poss[cell], tris[cell], owners[cell], state_costs)
+        if mask is None:
+            break
+        cells[idx:idx + 1] = [ cell[mask], cell[~mask] ]
+
+    return [ [ (np.sort(cell[owners[cell] == i]) - tri_offsets[i]).tolist() for i in range(len(chunks)) ] for cell in cells ]
+
+# State commands a later command of the same slot replaces entirely, with the arguments naming the slot
+STATE_SLOT_ARGS = {
+    'gsDPSetTextureImage': (),
+    'gsDPSetTile': (4,),
+    'gsDPSetTileSize': (0,),
+    'gsDPSetCombineLERP': (),
+    'gsDPSetCombineMode': (),
+    'gsDPSetCycleType': (),
+    'gsDPSetRenderMode': (),
+    'gsDPSetTextureFilter': (),
+    'gsDPSetTextureLUT': (),
+    'gsDPSetTexturePersp': (),
+    'gsDPSetTextureLOD': (),
+    'gsDPSetTextureDetail': (),
+    'gsDPSetTextureConvert': (),
+    'gsDPSetAlphaCompare': (),
+    'gsDPSetAlphaDither': (),
+    'gsDPSetColorDither': (),
+    'gsDPSetCombineKey': (),
+    'gsDPSetDepthSource': (),
+    'gsDPPipelineMode': (),
+    'gsDPSetFogColor': (),
+    'gsDPSetEnvColor': (),
+    'gsDPSetPrimColor': (),
+    'gsDPSetBlendColor': (),
+    'gsSPTexture': (),
+    'gsSPLightColor': (0,),
+    'gsMoveWd': (0, 1),
+}
+# Loads into TMEM, the tile they load through is their first argument
+STATE_LOADS = { 'gsDPLoadBlock', 'gsDPLoadTile', 'gsDPLoadTLUTCmd' }
+# Commands changing only part of their state, kept but they do not read any other state
+STATE_PARTIAL = { 'gsSPGeometryMode', 'gsSPSetGeometryMode', 'gsSPClearGeometryMode' }
+STATE_SYNCS = { 'gsDPPipeSync', 'gsDPLoadSync', 'gsDPTileSync' }
+STATE_RE = re.compile(r'\s*(gs\w+)\((.*)\)')
+
+def _state_slots(data):
+    # What every line of 'data' writes and reads: (slot, reads), None when it is not a state command the pruning
+    # understands, 'sync' for syncs and 'partial' for STATE_PARTIAL
+    tiles = {}
+    slots = []
+    for line in data:
+        match = STATE_RE.match(line) if isinstance(line, str) else None
+        if not match:
+            slots.append(None)
+            continue
+        name = match.group(1)
+        args = [ arg.strip() for arg in match.group(2).split(',') ]
+        if name in STATE_SYNCS:
+            slots.append('sync')
+        elif name in STATE_PARTIAL:
+            slots.append('partial')
+        elif name in STATE_SLOT_ARGS and all(i < len(args) for i in STATE_SLOT_ARGS[name]):
+            if 'gsDPSetTile' == name:
+                # TMEM address and texel size of the tile, loads through it write there
+                tiles[args[4]] = (args[3], args[1])
+            slots.append(((name, *(args[i] for i in STATE_SLOT_ARGS[name])), ()))
+        elif name in STATE_LOADS and args[0] in tiles:
+            # Only a load of the same texels to the same place replaces a load
+            slots.append((('tmem', *tiles[args[0]], name, *args[1:]), (('gsDPSetTextureImage',), ('gsDPSetTile', args[0]))))
+        else:
+            slots.append(None)
+    return slots
+
+def _prune_state(data):
+    # Drops state commands of a sub-list that a later command replaces before any chunk draws with them,
+    # which is the state in front of the chunks the cell left out. Nothing after the last chunk is read either,
+    # a sub-list may be culled so the lists after it cannot rely on what it leaves behind.
+    # Syncs go together with the command after them.
+    slots = _state_slots(data)
+    keep = [ True ] * len(data)
+    dead = set()
+    tail = True
+    next_kept = False
+    for i in range(len(data) - 1, -1, -1):
+        line = data[i]
+        slot = slots[i]
+        if 'sync' == slot:
+            keep[i] = next_kept
+            continue
+        if 'partial' == slot:
+            next_kept = True
+            continue
+        if slot is None:
+            if isinstance(line, ModelMeshEntry) or STATE_RE.match(line) or line.lstrip().startswith('#'):
+                # Chunks draw with all of the state, anything else may read it as well
+                dead = set()
+                tail = False
+                next_kept = True
+            continue
+        written, reads = slot
+        next_kept = not tail and written not in dead
+        if not next_kept:
+            keep[i] = False
+            continue
+        dead.add(written)
+        dead.difference_update(reads)
+
+    return [ line for line, kept in zip(data, keep) if kept ]
+
+def split_list(mlist):
+    # Sub-lists drawing a cell of split_triangles() each, the list keeps what follows its last chunk and calls them
+    chunks = [ line for line in mlist.data if isinstance(line, ModelMeshEntry) ]
+    if sum(len(chunk._triangles) for chunk in chunks) < 2 * SPLIT_MIN_TRIANGLES:
+        return []
+
+    state_costs = []
+    count = 0
+    for line in mlist.data[1:]:
+        if isinstance(line, ModelMeshEntry):
+            state_costs.append(count)
+            count = 0
+        elif STATE_RE.match(line):
+            count += 1
+    cells = split_triangles(chunks, SPLIT_COUNT, state_costs)
+    if len(cells) < 2:
+        return []
+
+    last = max(i for i, line in enumerate(mlist.data) if isinstance(line, ModelMeshEntry))
+    parts = []
+    for cell in cells:
+        part = ModelMeshEntryList(f'Gfx {mlist.name}_part{len(parts)}[] = {{\n')
+        part.part = True
+        part.cullable = True
+        chunk_tris = iter(cell)
+        num = 0
+        lines = []
+        for line in mlist.data[1:last + 1]:
+            if not isinstance(line, ModelMeshEntry):
+                lines.append(line)
+                continue
+            tri_ids = next(chunk_tris)
+            if tri_ids:
+                lines.append(line.subset(f'{part.name}_{num}', tri_ids))
+                num += 1
+        part.data += _prune_state(lines) + [ '\tgsSPEndDisplayList(),\n', '};\n' ]
+        if SHARE_VTX_BUFFER:
+            _mark_shared_chunks(part.data)
+        parts.append(part)
+
+    PROFILER.count('split_lists')
+    PROFILER.count('split_parts', len(parts))
+    PROFILER.count('split_dup_vertices', sum(len(line._vertices) for part in parts for line in part.data if isinstance(line, ModelMeshEntry)) - sum(len(chunk._vertices) for chunk in chunks))
+    PROFILER.count('split_dup_state', sum(1 for part in parts for line in part.data[1:-2] if isinstance(line, str) and STATE_RE.match(line))
+                   - sum(1 for line in mlist.data[1:last + 1] if isinstance(line, str) and STATE_RE.match(line)))
+    mlist.data = [ mlist.data[0] ] + [ f'\tgsSPDisplayList({part.name}),\n' for part in parts ] + mlist.data[last + 1:]
+    mlist.parts = parts
+    mlist.cullable = False
+    return parts
+
+def optimize_model(model, vtx_filter=None, jobs=1, cache=None):
+    # First parse every display list leaving the mesh entries in place of their draws...
+    PROFILER.push('parse')
+    mlists = []
+    tasks = []
     for model_entry_idx in range(len(model.entries)):
         old_entry = model.entries[model_entry_idx]
         if not isinstance(old_entry, ModelRawEntry):
@@ -1268,159 +2686,425 @@ def optimize_model(model, vtx_filter=None):
 
         num = 0
         have_tile = None
+        list_have_tile = False
+        list_tasks = []
+        old_draws = [ parse_draw(line) for line in old_entry.data ] + [ None ]
         for i in range(1, len(old_entry.data)):
             line = old_entry.data[i]
-            print(line)
+            draw = old_draws[i]
+            log_debug(line)
             if 'gsDPLoadTile' in line:
                 have_tile = True
+                list_have_tile = True
 
-            nline = old_entry.data[i+1] if i + 1 < len(old_entry.data) else None
-            if not _is_draw(line, nline):
+            if not _is_draw(draw, old_draws[i+1]):
                 if entry:
-                    draws, vtxopt = entry.compile(have_tile, vtx_filter)
+                    list_tasks.append((entry, have_tile))
                     have_tile = False
-                    mlist.data.extend(draws)
-                    mlist.opvtxs.append(vtxopt)
+                    mlist.data.append(entry)
 
                     entry = None
+                # A load with state commands before its triangles stays in the list as is, the
+                # chunk drawing them still needs to know what it left in the buffer
+                if draw and 'gsSPVertex' == draw[0]:
+                    parser.load(model, draw[1])
                 mlist.data.append(line)
                 continue
             else:
                 if not entry:
                     entry = ModelMeshEntry(line, model, f'{mlist.name}_{num}', parser)
                     num += 1 
-                entry.add(line)
+                entry.add(draw)
                 
-                if 'gsSPVertex' in line:
-                    vtx_args = get_args(line)
-                    vtx_arg = vtx_args[0]
-                    vtx_arg_split = vtx_arg.split(' ')
+                if 'gsSPVertex' == draw[0]:
+                    vtx_arg_split = draw[1][0].split(' ')
                     _, vtx = model.find(vtx_arg_split[0])
                     vtx.used = True
 
+        # Culling a chunk ends the list so it must be the last thing in it doing anything
+        chunks = [ line for line in mlist.data if isinstance(line, ModelMeshEntry) ]
+        tail_safe = False
+        for line in reversed(mlist.data):
+            if isinstance(line, ModelMeshEntry):
+                tail_safe = True
+                break
+            if not CULL_SAFE_TAIL_RE.match(line):
+                break
+
+        if SHARE_VTX_BUFFER:
+            _mark_shared_chunks(mlist.data)
+
+        if 1 == len(chunks) and tail_safe:
+            chunks[0].cullable = True
+        elif chunks and not list_have_tile and sum(len(chunk._triangles) for chunk in chunks) >= CULL_MIN_TRIANGLES:
+            mlist.cullable = True
+
+        # Parts are compiled in place of the chunks of the list and go before it everywhere
+        parts = []
+        if SPLIT_COUNT > 1 and mlist.cullable and not _calls_geometry(model, mlist):
+            with PROFILER.phase('split'):
+                parts = split_list(mlist)
+        if parts:
+            tasks.extend((line, False) for part in parts for line in part.data if isinstance(line, ModelMeshEntry))
+            mlists.extend(parts)
+        else:
+            tasks.extend(list_tasks)
+
         model.entries[model_entry_idx] = mlist
+        mlists.append(mlist)
         #entry = ModelMeshEntry(old_entry.data[0], old_entry.data[1], model)
         #for i in range(1, len(old_entry.data)):
         #    entry.add(old_entry.data[i])
 
         #model.entries[model_entry_idx] = entry.compile()
 
+    PROFILER.pop()
+
+    # ...then compile them and put the draws back in the source order
+    results = iter(_compile_entries_cached(tasks, vtx_filter, jobs, cache))
+    for mlist in mlists:
+        data = []
+        for line in mlist.data:
+            if isinstance(line, ModelMeshEntry):
+                draws, vtxopt = next(results)
+                data.extend(draws)
+                mlist.opvtxs.append(vtxopt)
+            else:
+                data.append(line)
+        mlist.data = data
+
+    for mlist in mlists:
+        # Parts exist to be culled so they are whatever CULL_MODE is
+        if mlist.part or (CULL_MODE != 'off' and mlist.cullable and not _calls_geometry(model, mlist)):
+            _cull_list(mlist)
+
+def _calls_geometry(model, mlist):
+    # Lists not in the model might draw anything
+    for line in mlist.data[1:]:
+        # Chunks still waiting for compile() draw only their own vertices
+        if isinstance(line, ModelMeshEntry):
+            continue
+        match = SUB_DL_RE.match(line)
+        if not match:
+            continue
+        try:
+            _, entry = model.find(match.group(1))
+        except KeyError:
+            return True
+        if not isinstance(entry, ModelMeshEntryList) or any('gsSPVertex' in line for line in entry.data) or _calls_geometry(model, entry):
+            return True
+    return False
+
+def _cull_list(mlist):
+    # Geometry drawn by called lists would not be in the volume so those are not culled
+    records = [ vtx_entry.record(i) for vtx_entry in mlist.opvtxs for i in range(len(vtx_entry)) ]
+    # Parts of a split list are culled however big they are, they cover only some of the list anyway
+    hull_indices, cull_records = cull_volume([ Vtx(VTX_STRUCT.unpack(record)) for record in records ], None if mlist.part else CULL_MAX_EXTENT)
+    if hull_indices:
+        cull_records = [ records[i] for i in hull_indices ]
+    if not cull_records:
+        return
+
+    vtx_entry = ModelVtxEntry(f'static Vtx {mlist.name}_cull_vtx{VTX_SUFFIX}[] = {{\n')
+    vtx_entry.records = b''.join(cull_records)
+    vtx_entry.used = True
+    mlist.opvtxs.insert(0, vtx_entry)
+    mlist.data[1:1] = [ f"\tgsSPVertex({vtx_entry.name}, {len(cull_records)}, 0),\n",
+                        f"\tgsSPCullDisplayList(0, {len(cull_records) - 1}),\n" ]
+
+HEADER_GFX_RE = re.compile(r'\s*extern\s+Gfx\s+(\w+)\s*\[')
+
 def serialize_model(model, path):
+    with PROFILER.phase('serialize'):
+        _serialize_model(model, path)
+
+def _serialize_model(model, path):
     with open(path, "w") as f_model:
-        model.entries = [entry for entry in model.entries if entry]
+        model.entries = [entry for entry in model.entries if entry is not None]
 
         for entry in model.entries:
             if isinstance(entry, ModelVtxEntry):
                 if not entry.used:
                     f_model.write(entry.raw_name)
-                    for line in entry.vertices:
-                        f_model.write(line)
+                    f_model.writelines(entry.lines())
                     f_model.write('\n')
 
                 continue
 
 
             if isinstance(entry, ModelMeshEntryList):
-                for entry_vertices in entry.opvtxs:
-                    f_model.write(entry_vertices.raw_name)
-                    for line in entry_vertices.vertices:
-                        f_model.write(line)
-                    f_model.write('\n')
+                for part in entry.parts:
+                    _serialize_list(f_model, part)
+                _serialize_list(f_model, entry)
+                continue
 
             for line in entry.data:
                 f_model.write(line)
 
             f_model.write('\n')
 
-def patch_header(header_path, header_patched_path):
+def _serialize_list(f_model, mlist):
+    for entry_vertices in mlist.opvtxs:
+        f_model.write(entry_vertices.raw_name)
+        f_model.writelines(entry_vertices.lines())
+        f_model.write('\n')
+
+    for line in mlist.data:
+        f_model.write(line)
+
+    f_model.write('\n')
+
+def patch_header(header_path, header_patched_path, model=None):
     with open(header_path, "r") as f_header:
         lines = f_header.readlines()
 
+    # Sub-lists of split lists are declared right before their list
+    parts = {}
+    for entry in model.entries if model else []:
+        if isinstance(entry, ModelMeshEntryList) and entry.parts:
+            parts[entry.name] = entry.parts
+
     with open(header_patched_path, "w") as f_header:
         for line in lines:
             if 'Vtx' in line:
                 continue
+            match = HEADER_GFX_RE.match(line)
+            if match and match.group(1) in parts:
+                f_header.writelines(f'extern Gfx {part.name}[];\n' for part in parts[match.group(1)])
             f_header.write(line)
 
+# Lines indexize_lines() has to know about besides the draws, one pattern so the vertex records cost a single match:
+# 'neutral' change neither the vertex buffer nor how triangles are drawn, triangle runs continue across them.
+# After a 'barrier' the vertex buffer has to look like the original display list left it: called lists may draw from it,
+# and preprocessor branches or vertex loads the indexer does not parse make its layout unknown.
+INDEXIZE_LINE_RE = re.compile(r'\s*(?:(?P<neutral>gsDPPipeSync\(|gsDPTileSync\(|gsDPLoadSync\(|gsDPNoOp\(|//|$)|'
+                              r'(?P<barrier>gsSPDisplayList\(|gsSPBranchList\(|gsSPEndDisplayList\(|gsSPCullDisplayList\(|gsSPVertex\(|#|}))')
+
 class ModelVtxIndexer(TriKit):
+    # Collects triangles until something changes how they are drawn.
+    # Loads replacing the whole buffer go above the vertices the pending triangles use, when they fit,
+    # so triangles of consecutive loads become one run and stripify across the load boundary.
     def __init__(self):
         self._reset()
+        self._held = []
+        # Original buffer slots are at '_base' and up, '_top' is the end of the buffer in use
+        self._base = 0
+        self._top = 0
+        # Loads since the last one replacing the whole buffer and the end of what they loaded, in original slots
+        self._loads = []
+        self._vtx_top = 0
+        # Lines after a load that may go above the pending triangles, until it is known if that is free
+        self._lookahead = None
+        self._lookahead_top = 0
 
     def _reset(self):
         self._triangles_lookup = set()
         self._triangles = []
+        # Where the runs the original display list draws start in '_triangles'
+        self._groups = [ 0 ]
+
+    def _split(self):
+        if self._triangles and self._groups[-1] != len(self._triangles):
+            self._groups.append(len(self._triangles))
+
+    def feed(self, line, draw):
+        # Display list lines that can be written out after 'line', 'draw' is its parse_draw
+        if self._lookahead is not None:
+            return self._look(line, draw)
+
+        if draw and 'gsSP2Triangles' == draw[0]:
+            args = draw[1]
+            self.tri([ int(args[0]), int(args[1]), int(args[2]) ])
+            self.tri([ int(args[4]), int(args[5]), int(args[6]) ])
+            return []
+        if draw and 'gsSP1Triangle' == draw[0]:
+            args = draw[1]
+            self.tri([ int(args[0]), int(args[1]), int(args[2]) ])
+            return []
+        if draw:
+            return self.load(line, draw[1])
+
+        match = INDEXIZE_LINE_RE.match(line)
+        kind = match.lastgroup if match else None
+        if 'neutral' == kind:
+            return self.neutral(line)
+        lines = self.barrier(line) if 'barrier' == kind else self.flush()
+        lines.append(line)
+        return lines
 
     def tri(self, tri):
         if self._tri_trivial(tri):
             return
 
-        tri = self._tri_normalize(tri)
+        tri = self._tri_normalize([ self._base + vtx for vtx in tri ])
         if tri in self._triangles_lookup:
             return
 
         self._triangles.append(tri)
         self._triangles_lookup.add(tri)
-    
-    def flush(self, f_model):
-        if not self._triangles:
-            return
 
-        triangles, strips = TriKit.stripify(self._triangles)
-        self._reset()
+    def neutral(self, line):
+        if self._triangles:
+            self._split()
+            self._held.append(line)
+            return []
+        return [ line ]
+
+    def load(self, line, args):
+        amount = _int_expr(args[1])
+        dst = _int_expr(args[2])
+        if 0 == dst and amount >= self._vtx_top:
+            if self._triangles and self._top + amount <= VTX_BUF_SIZE:
+                # Going above the pending triangles is free only if nothing has to be loaded to the original slots
+                # again before the next load replacing the whole buffer, decided once that load or a barrier is seen
+                self._lookahead = [ (line, ('gsSPVertex', args)) ]
+                self._lookahead_top = amount
+                return []
+            return self._fresh_load(line, args, False)
+
+        lines = []
+        if self._base + dst + amount > VTX_BUF_SIZE:
+            lines += self.flush()
+            lines += self.restore()
+        elif any(self._base + dst <= vtx < self._base + dst + amount for tri in self._triangles for vtx in tri):
+            lines += self.flush()
+        self._split()
+        return lines + self._add_load(line, args, dst + amount)
+
+    def _fresh_load(self, line, args, above):
+        lines = []
+        if above:
+            self._split()
+        else:
+            lines += self.flush()
+            self._top = 0
+        self._base = self._top
+        self._loads = []
+        self._vtx_top = 0
+        return lines + self._add_load(line, args, _int_expr(args[1]))
+
+    def _add_load(self, line, args, end):
+        self._loads.append((line, args))
+        self._vtx_top = max(self._vtx_top, end)
+        self._top = max(self._top, self._base + end)
+        return [ self._load_line(line, args, self._base) ]
+
+    def _look(self, line, draw):
+        self._lookahead.append((line, draw))
+        if draw and 'gsSPVertex' == draw[0]:
+            amount = _int_expr(draw[1][1])
+            dst = _int_expr(draw[1][2])
+            if 0 == dst and amount >= self._lookahead_top:
+                return self._resolve(True)
+            if self._top + dst + amount > VTX_BUF_SIZE:
+                return self._resolve(False)
+            self._lookahead_top = max(self._lookahead_top, dst + amount)
+        elif not draw:
+            match = INDEXIZE_LINE_RE.match(line)
+            if match and 'barrier' == match.lastgroup:
+                return self._resolve(False)
+        return []
+
+    def _resolve(self, above):
+        lookahead = self._lookahead
+        self._lookahead = None
+        line, draw = lookahead[0]
+        lines = self._fresh_load(line, draw[1], above)
+        for line, draw in lookahead[1:]:
+            lines += self.feed(line, draw)
+        return lines
 
-        triangles = deque(triangles)
-        while triangles:
-            if HAS_TRI3:
-                if 1 == len(triangles):
-                    tri = triangles.popleft()
-                    f_model.write(f"\tgsSP1Triangle({tri[0]}, {tri[1]}, {tri[2]}, 0),\n")
-                elif 2 == len(triangles):
-                    tri0 = triangles.popleft()
-                    tri1 = triangles.popleft()
-                    f_model.write(f"\tgsSP2Triangles({tri0[0]}, {tri0[1]}, {tri0[2]}, 0, {tri1[0]}, {tri1[1]}, {tri1[2]}, 0),\n")
-                elif 4 == len(triangles):
-                    # 4 triangles is better presented as 2xTRI2 commands - same amount of commands but less RSP work
-                    tri0 = triangles.popleft()
-                    tri1 = triangles.popleft()
-                    tri2 = triangles.popleft()
-                    tri3 = triangles.popleft()
-                    f_model.write(f"\tgsSP2Triangles({tri0[0]}, {tri0[1]}, {tri0[2]}, 0, {tri1[0]}, {tri1[1]}, {tri1[2]}, 0),\n")
-                    f_model.write(f"\tgsSP2Triangles({tri2[0]}, {tri2[1]}, {tri2[2]}, 0, {tri3[0]}, {tri3[1]}, {tri3[2]}, 0),\n")
-                else:
-                    tri0 = triangles.popleft()
-                    tri1 = triangles.popleft()
-                    tri2 = triangles.popleft()
-                    f_model.write(f"\tgsSP3Triangles({tri0[0]}, {tri0[1]}, {tri0[2]}, {tri1[0]}, {tri1[1]}, {tri1[2]}, {tri2[0]}, {tri2[1]}, {tri2[2]}),\n")
-            else:
-                if 1 == len(triangles):
-                    tri = triangles.popleft()
-                    f_model.write(f"\tgsSP1Triangle({tri[0]}, {tri[1]}, {tri[2]}, 0),\n")
-                else:
-                    tri0 = triangles.popleft()
-                    tri1 = triangles.popleft()
-                    f_model.write(f"\tgsSP2Triangles({tri0[0]}, {tri0[1]}, {tri0[2]}, 0, {tri1[0]}, {tri1[1]}, {tri1[2]}, 0),\n")
+    @staticmethod
+    def _load_line(line, args, base):
+        if not base:
+            return line
+        indent = line[:len(line) - len(line.lstrip())]
+        return f"{indent}gsSPVertex({args[0]}, {args[1]}, {base + _int_expr(args[2])}),\n"
+
+    def restore(self):
+        # Loads the vertices again where the original display list has them, the pending triangles must be flushed
+        if not self._base:
+            return []
+
+        self._base = 0
+        self._top = self._vtx_top
+        return [ self._load_line(line, args, 0) for line, args in self._loads ]
+
+    def barrier(self, line):
+        lines = self.flush() + self.restore()
+        if line.lstrip().startswith('gsSPVertex'):
+            # Not a load parse_draw understands, nothing short of a full load can be moved after it
+            self._loads = []
+            self._vtx_top = VTX_BUF_SIZE
+            self._top = VTX_BUF_SIZE
+        return lines
+
+    def finish(self):
+        lines = self._resolve(False) if self._lookahead is not None else []
+        return lines + self.flush()
+
+    def flush(self):
+        # Display list lines drawing the triangles collected since the last flush, then the lines held back meanwhile.
+        # The runs are stripified together and one by one, as the original display list would draw them,
+        # and the fewer lines win so joining runs never costs commands.
+        draws = []
+        if self._triangles:
+            triangles, strips = TriKit.stripify(self._triangles)
+            draws = emit_draws(triangles, strips)
+            if len(self._groups) > 1:
+                group_draws = []
+                for start, end in zip(self._groups, self._groups[1:] + [ len(self._triangles) ]):
+                    triangles, strips = TriKit.stripify(self._triangles[start:end])
+                    group_draws += emit_draws(triangles, strips)
+                if len(group_draws) <= len(draws):
+                    draws = group_draws
+            self._reset()
+
+        draws += self._held
+        self._held = []
+        return draws
+
+# Output lines held before they are handed to the file
+WRITE_BUFFER_LINES = 4096
+
+class LineWriter:
+    # Batches lines so the file gets one writelines per flush instead of a write per line
+    def __init__(self, f, limit=WRITE_BUFFER_LINES):
+        self._f = f
+        self._limit = limit
+        self._lines = []
+
+    def write(self, line):
+        self._lines.append(line)
+        if len(self._lines) >= self._limit:
+            self.flush()
+
+    def writelines(self, lines):
+        lines = iter(lines)
+        while True:
+            self._lines.extend(itertools.islice(lines, self._limit - len(self._lines)))
+            if len(self._lines) < self._limit:
+                return
+            self.flush()
+
+    def flush(self):
+        if self._lines:
+            self._f.writelines(self._lines)
+            self._lines = []
+
+def indexize_lines(lines):
+    # Streams the model through, only the current run of triangles and the lookahead lines are held in memory
+    indexer = ModelVtxIndexer()
+    for line in lines:
+        yield from indexer.feed(line, parse_draw(line))
 
-        for strip in strips:
-            for line in strip.stringify_x():
-                f_model.write(line)
+    yield from indexer.finish()
 
 def indexize_model(model_path, model_patched_path):
-    with open(model_path, "r") as f_model:
-        lines = f_model.readlines()
-
-    indexer = ModelVtxIndexer()
-    with open(model_patched_path, "w") as f_model:
-        for line in lines:
-            if 'gsSP2Triangles' in line:
-                args = get_args(line)
-                indexer.tri([ int(args[0]), int(args[1]), int(args[2]) ])
-                indexer.tri([ int(args[4]), int(args[5]), int(args[6]) ])
-            elif 'gsSP1Triangle' in line:
-                args = get_args(line)
-                indexer.tri([ int(args[0]), int(args[1]), int(args[2]) ])
-            else:
-                indexer.flush(f_model)
-                f_model.write(line)
+    with open(model_path, "r") as f_in, open(model_patched_path, "w") as f_model, PROFILER.phase('indexize'):
+        writer = LineWriter(f_model)
+        writer.writelines(indexize_lines(f_in))
+        writer.flush()
 
 def make_opt_name(path):
     extensions = [ '.inc.c', '.inc.h', '.h', '.c' ]
@@ -1430,17 +3114,228 @@ def make_opt_name(path):
 
     assert False, f"unknown extension for {path}"
 
-if '__main__' in __name__:
-    model_path = sys.argv[1]
-    model_patched_path = make_opt_name(model_path)
+def make_report_name(model_path):
+    return make_opt_name(model_path)[:-len('.inc.c')] + '.report.json'
+
+def optimize_file(model_path, header_path, vtx_filter=None, jobs=1, cache=None, report=False):
+    PROFILER.reset()
+    start = time.perf_counter()
 
-    if len(sys.argv) >= 3:
-        header_path = sys.argv[2]
+    model_patched_path = make_opt_name(model_path)
+    if header_path:
         header_patched_path = make_opt_name(header_path)
 
         model = load_model(model_path)
-        optimize_model(model, VTX_FILTER)
+        optimize_model(model, vtx_filter, jobs, cache)
         serialize_model(model, model_patched_path)
-        patch_header(header_path, header_patched_path)
+        patch_header(header_path, header_patched_path, model)
+        if SPLIT_COUNT > 1 and VERBOSE:
+            print(f"{model_path}: split {PROFILER.counters.get('split_lists', 0)} lists into {PROFILER.counters.get('split_parts', 0)} parts, duplicating {PROFILER.counters.get('split_dup_vertices', 0)} vertices and {PROFILER.counters.get('split_dup_state', 0)} state commands")
+        if WELD_POS_TOLERANCE is not None:
+            print(f"{model_path}: welded {PROFILER.counters.get('weld_merged', 0)} of {PROFILER.counters.get('weld_vertices', 0)} vertices")
     else:
         indexize_model(model_path, model_patched_path)
+
+    if report:
+        with open(make_report_name(model_path), "w") as f_report:
+            json.dump({ 'model': model_path, 'header': header_path, 'settings': _compile_settings(), 'jobs': jobs,
+                        'total': time.perf_counter() - start, **PROFILER.snapshot() }, f_report, indent=1, sort_keys=True)
+
+def collect_batch(patterns, manifest_path):
+    # Glob patterns pick up models that have a header right next to them, the manifest lists "model [header]" per line.
+    # A manifest line without a header is indexized only, same as running the script with a single argument.
+    pairs = []
+    for pattern in patterns or []:
+        model_paths = sorted(glob.glob(pattern))
+        # Patterns like '*.inc.c' also match previous outputs
+        outputs = set(make_opt_name(model_path) for model_path in model_paths)
+        for model_path in model_paths:
+            if model_path in outputs:
+                continue
+            header_path = model_path[:-len('.c')] + '.h'
+            if not os.path.exists(header_path):
+                print(f"skip {model_path}: no header {header_path}")
+                continue
+            pairs.append((model_path, header_path))
+
+    if manifest_path:
+        with open(manifest_path, "r") as f_manifest:
+            for line in f_manifest:
+                line = line.split('#')[0].strip()
+                if not line:
+                    continue
+                paths = line.split()
+                pairs.append((paths[0], paths[1] if len(paths) > 1 else None))
+
+    return pairs
+
+def _batch_outputs(model_path, header_path):
+    outputs = [ make_opt_name(model_path) ]
+    if header_path:
+        outputs.append(make_opt_name(header_path))
+    return outputs
+
+def _batch_digest(model_path, header_path, vtx_filter):
+    h = hashlib.sha256()
+    h.update(_source_digest())
+    h.update(json.dumps([ _compile_settings(), _filter_key(vtx_filter) ]).encode())
+    for path in [ model_path, header_path ]:
+        if path:
+            with open(path, "rb") as f:
+                h.update(f.read())
+    return h.hexdigest()
+
+def _batch_up_to_date(model_path, header_path, vtx_filter, stamps):
+    # Cheap check first: outputs that are newer than the inputs and the optimizer itself are up to date...
+    outputs = _batch_outputs(model_path, header_path)
+    if not all(os.path.exists(path) for path in outputs):
+        return False
+
+    inputs = [ path for path in [ model_path, header_path, __file__ ] if path ]
+    if min(os.path.getmtime(path) for path in outputs) >= max(os.path.getmtime(path) for path in inputs):
+        return True
+
+    # ...otherwise inputs could have been only touched (for example by git checkout), compare the content
+    if stamps is None or stamps.get(model_path) != _batch_digest(model_path, header_path, vtx_filter):
+        return False
+
+    for path in outputs:
+        os.utime(path)
+    return True
+
+def _batch_run(task, vtx_filter):
+    model_path, header_path, cache_path, cache_size, report = task
+    cache = CompileCache(cache_path, cache_size) if cache_path else None
+    start = time.perf_counter()
+    optimize_file(model_path, header_path, vtx_filter, 1, cache, report)
+    elapsed = time.perf_counter() - start
+    return elapsed, (cache.hits, cache.misses) if cache else (0, 0)
+
+def _batch_worker(task):
+    return _batch_run(task, _worker_vtx_filter)
+
+def run_batch(pairs, vtx_filter=None, jobs=1, cache_path=None, cache_size=0, force=False, stamps_path=None, report=False):
+    stamps = None
+    if stamps_path:
+        try:
+            with open(stamps_path, "r") as f:
+                stamps = json.load(f)
+        except (OSError, ValueError):
+            stamps = {}
+
+    todo = []
+    todo_indices = []
+    summary = [ (model_path, 'skip', 0.0) for model_path, _ in pairs ]
+    for i, (model_path, header_path) in enumerate(pairs):
+        if force or not _batch_up_to_date(model_path, header_path, vtx_filter, stamps):
+            todo.append((model_path, header_path, cache_path, cache_size, report))
+            todo_indices.append(i)
+
+    # Files are spread across the processes, chunks of each file are compiled serially
+    start = time.perf_counter()
+    if jobs > 1 and len(todo) > 1:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_compile_worker_init, initargs=(_compile_settings(), vtx_filter)) as executor:
+            results = list(executor.map(_batch_worker, todo))
+    else:
+        results = [ _batch_run(task, vtx_filter) for task in todo ]
+    total = time.perf_counter() - start
+
+    hits = 0
+    misses = 0
+    for i, (elapsed, (task_hits, task_misses)) in zip(todo_indices, results):
+        model_path, header_path = pairs[i]
+        summary[i] = model_path, 'done', elapsed
+        hits += task_hits
+        misses += task_misses
+        if stamps is not None:
+            stamps[model_path] = _batch_digest(model_path, header_path, vtx_filter)
+
+    if stamps is not None:
+        with open(stamps_path, "w") as f:
+            json.dump(stamps, f, indent=1, sort_keys=True)
+
+    width = max([ len(model_path) for model_path, _, _ in summary ] + [ 0 ])
+    for model_path, status, elapsed in summary:
+        print(f"{model_path.ljust(width)}  {status}  {elapsed:8.2f}s")
+    print(f"{len(todo)} optimized, {len(summary) - len(todo)} up to date, {total:.2f}s total")
+    if cache_path:
+        print(f"cache: {hits} hits, {misses} misses")
+
+# Worker processes import this file as '__mp_main__' so the check must be exact
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Optimize display lists of a model, or only indexize it if no header is given')
+    parser.add_argument('model_path', nargs='?')
+    parser.add_argument('header_path', nargs='?')
+    parser.add_argument('--strip-algo', choices=['greedy', 'dfs'], default=STRIP_ALGO, help='strip builder to use, dfs is the exhaustive search to compare against')
+    parser.add_argument('--vtx-loader', choices=['greedy', 'partition'], default=VTX_LOADER, help='vertex loader for chunks bigger than the vertex buffer')
+    parser.add_argument('--tri-reorder', action='store_true', help='reorder triangles of big chunks for vertex buffer locality before loading vertices')
+    parser.add_argument('--cull', choices=['off', 'aabb', 'auto'], default=CULL_MODE, help='prefix the last chunk of display lists with gsSPCullDisplayList')
+    parser.add_argument('--split', type=int, metavar='N', default=SPLIT_COUNT, help='split cullable display lists into up to N spatial sub-lists culled on their own')
+    parser.add_argument('--share-buffer', action='store_true', help='reuse vertices left in the buffer by the previous chunk across material changes')
+    parser.add_argument('--weld', type=int, metavar='TOL', default=WELD_POS_TOLERANCE, help='merge vertices of a chunk within TOL units of each other before compiling it')
+    parser.add_argument('--weld-uv', type=int, metavar='TOL', default=WELD_UV_TOLERANCE, help='UV tolerance of --weld')
+    parser.add_argument('--weld-color', type=int, metavar='TOL', default=WELD_COLOR_TOLERANCE, help='color tolerance of --weld')
+    parser.add_argument('--retriangulate', type=float, metavar='TOL', default=RETRI_TOLERANCE, help='retriangulate flat regions of triangles within TOL units of a plane without their inner vertices')
+    parser.add_argument('--vtx-filter', metavar='EXPR', default=VTX_FILTER, help='drop vertices EXPR is true for, e.g. "y < 373", and triangles left without vertices; x, y, z, u, v, r, g, b, a are numpy arrays')
+    parser.add_argument('--vtx-filter-box', metavar='X0,Y0,Z0,X1,Y1,Z1', help='drop vertices outside of the box, combines with --vtx-filter')
+    parser.add_argument('--vtx-suffix', default=VTX_SUFFIX, help='suffix of the output files, use a different one for each filter')
+    parser.add_argument('--emit-costs', metavar='FILE', help='json with "command" and "triangle" costs of triangle commands overriding the defaults')
+    parser.add_argument('--jobs', '-j', type=int, default=1, help='compile mesh chunks in N processes, or whole files in batch mode')
+    parser.add_argument('--cache', metavar='DIR', help='reuse compiled mesh chunks stored in DIR')
+    parser.add_argument('--cache-size', type=int, default=256, help='cache size limit in megabytes')
+    parser.add_argument('--batch', metavar='GLOB', action='append', help='optimize every model matching GLOB that has a header next to it')
+    parser.add_argument('--manifest', metavar='FILE', help='optimize "model [header]" pairs listed in FILE')
+    parser.add_argument('--stamps', metavar='FILE', help='batch mode: remember input hashes in FILE to skip models that were only touched')
+    parser.add_argument('--force', action='store_true', help='batch mode: optimize models even if outputs are up to date')
+    parser.add_argument('--report', action='store_true', help='write phase timings and counters of each model to a json file next to its output')
+    parser.add_argument('--profile', action='store_true', help='print phase timings and counters')
+    parser.add_argument('--verbose', '-v', action='store_true', help='echo display lists and debug logs while optimizing')
+    args = parser.parse_args()
+
+    STRIP_ALGO = args.strip_algo
+    VTX_LOADER = args.vtx_loader
+    TRI_REORDER = args.tri_reorder
+    CULL_MODE = args.cull
+    SHARE_VTX_BUFFER = args.share_buffer
+    SPLIT_COUNT = args.split
+    WELD_POS_TOLERANCE = args.weld
+    WELD_UV_TOLERANCE = args.weld_uv
+    WELD_COLOR_TOLERANCE = args.weld_color
+    RETRI_TOLERANCE = args.retriangulate
+    if args.emit_costs:
+        with open(args.emit_costs, "r") as f:
+            for command, cost in json.load(f).items():
+                if command not in EMIT_COSTS or not set(cost) <= { 'command', 'triangle' }:
+                    parser.error(f'unknown command cost in {args.emit_costs}: {command} {cost}')
+                EMIT_COSTS[command].update(cost)
+    VTX_SUFFIX = args.vtx_suffix
+    VTX_FILTER = None
+    if args.vtx_filter or args.vtx_filter_box:
+        box = None
+        if args.vtx_filter_box:
+            try:
+                box = [ int(value) for value in args.vtx_filter_box.split(',') ]
+            except ValueError:
+                box = []
+            if len(box) != 6:
+                parser.error(f'--vtx-filter-box needs 6 integers: {args.vtx_filter_box}')
+        try:
+            VTX_FILTER = VtxFilter(args.vtx_filter, box)
+        except SyntaxError as e:
+            parser.error(f'bad --vtx-filter expression: {e}')
+    VERBOSE = args.verbose
+    cache_size = args.cache_size * 1024 * 1024
+
+    if args.batch or args.manifest:
+        pairs = collect_batch(args.batch, args.manifest)
+        run_batch(pairs, VTX_FILTER, args.jobs, args.cache, cache_size, args.force, args.stamps, args.report)
+    else:
+        if not args.model_path:
+            parser.error('model_path is required unless --batch or --manifest is given')
+
+        cache = CompileCache(args.cache, cache_size) if args.cache else None
+        optimize_file(args.model_path, args.header_path, VTX_FILTER, args.jobs, cache, args.report)
+        if cache:
+            print(cache.report())
+        if args.profile:
+            print(PROFILER.format())
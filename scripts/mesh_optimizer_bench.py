@@ -0,0 +1,658 @@
+import argparse
+import glob
+import importlib.util
+import json
+import os
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+MESH_OPTIMIZER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mesh_optimizer.py')
+
+# Smallest model that goes through every step of both entry points
+STARTUP_MODEL = '''Vtx bench_vtx_0[] = {
+{{{ 0, 0, 0 }, 0, { 0, 0 }, { 255, 255, 255, 255}}},
+{{{ 100, 0, 0 }, 0, { 0, 0 }, { 255, 255, 255, 255}}},
+{{{ 0, 100, 0 }, 0, { 0, 0 }, { 255, 255, 255, 255}}},
+{{{ 100, 100, 0 }, 0, { 0, 0 }, { 255, 255, 255, 255}}},
+};
+
+Gfx bench_dl[] = {
+\tgsSPVertex(bench_vtx_0, 4, 0),
+\tgsSP2Triangles(0, 1, 2, 0, 2, 1, 3, 0),
+\tgsSPEndDisplayList(),
+};
+'''
+
+STARTUP_HEADER = '''extern Vtx bench_vtx_0[];
+extern Gfx bench_dl[];
+'''
+
+HEAVY_MODULES = [ 'numpy', 'scipy', 'shapely' ]
+
+# Runs the optimizer the same way the command line does and reports which heavy modules got imported
+STARTUP_RUNNER = '''
+import json, runpy, sys
+sys.argv = sys.argv[1:]
+runpy.run_path(sys.argv[0], run_name='__main__')
+sys.stderr.write(json.dumps([ m for m in {heavy} if m in sys.modules ]))
+'''
+
+def run_startup(runs):
+    with tempfile.TemporaryDirectory() as tmp:
+        model_path = os.path.join(tmp, 'bench.model.inc.c')
+        header_path = os.path.join(tmp, 'bench.model.inc.h')
+        with open(model_path, 'w') as f:
+            f.write(STARTUP_MODEL)
+        with open(header_path, 'w') as f:
+            f.write(STARTUP_HEADER)
+
+        entry_points = {
+            'indexize_model': [ model_path ],
+            'optimize_model': [ model_path, header_path ],
+        }
+
+        runner = STARTUP_RUNNER.format(heavy=HEAVY_MODULES)
+        results = {}
+        for name, args in entry_points.items():
+            timings = []
+            for _ in range(runs):
+                # Time the whole process, interpreter startup included, because that is what every build step pays
+                start = time.perf_counter()
+                proc = subprocess.run([ sys.executable, '-c', runner, MESH_OPTIMIZER_PATH ] + args, capture_output=True, text=True, check=True)
+                timings.append(time.perf_counter() - start)
+
+            results[name] = {
+                'min': min(timings),
+                'median': statistics.median(timings),
+                'heavy_imports': json.loads(proc.stderr.strip().splitlines()[-1]),
+            }
+
+    return results
+
+def load_mesh_optimizer():
+    spec = importlib.util.spec_from_file_location('mesh_optimizer', MESH_OPTIMIZER_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+# Models 'parse' runs on when none are given, a vanilla level and an actor, both with hex vertex colors
+PARSE_MODELS = [
+    os.path.join('levels', 'wf', 'areas', '1', '1', 'model.inc.c'),
+    os.path.join('actors', 'mario', 'model.inc.c'),
+]
+
+def check_round_trip(mesh_optimizer, model_path):
+    # Packs every Vtx array, writes the model back without optimizing it and compares what both files hold
+    model = mesh_optimizer.load_model(model_path)
+    for entry in model.entries:
+        if isinstance(entry, mesh_optimizer.ModelVtxEntry):
+            entry.pack()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        out_path = os.path.join(tmp, os.path.basename(model_path))
+        mesh_optimizer.serialize_model(model, out_path)
+        return load_model_lists(model_path) == load_model_lists(out_path)
+
+def run_parse(model_paths, runs, check):
+    mesh_optimizer = load_mesh_optimizer()
+    results = {}
+    for model_path in model_paths:
+        timings = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            model = mesh_optimizer.load_model(model_path)
+            timings.append(time.perf_counter() - start)
+
+        results[model_path] = {
+            'min': min(timings),
+            'median': statistics.median(timings),
+            'entries': len(model.entries),
+            'bytes': os.path.getsize(model_path),
+        }
+        if check:
+            results[model_path]['round_trip'] = check_round_trip(mesh_optimizer, model_path)
+
+    return results
+
+def print_parse(results):
+    width = max([ len(model_path) for model_path in results ] + [ 0 ])
+    for model_path, result in results.items():
+        round_trip = ''
+        if 'round_trip' in result:
+            round_trip = '  round trip ok' if result['round_trip'] else '  ROUND TRIP MISMATCH'
+        print(f"{model_path.ljust(width)}  {result['bytes'] // 1024:6}KB  min {result['min'] * 1000:7.1f}ms  median {result['median'] * 1000:7.1f}ms{round_trip}")
+    print(f"total min {sum(result['min'] for result in results.values()) * 1000:.1f}ms")
+
+# Gfx macros expanding to more than one 64-bit command, everything else is 1
+GFX_WORDS = {
+    'gsSPLightColor': 2,
+    'gsSPTextureRectangle': 3,
+    'gsDPLoadTextureBlock': 7,
+    'gsDPLoadTextureBlock_4b': 7,
+    'gsDPLoadMultiBlock': 7,
+    'gsDPLoadMultiBlock_4b': 7,
+    'gsDPLoadTLUT_pal16': 6,
+    'gsDPLoadTLUT_pal256': 6,
+}
+GFX_WORD_SIZE = 8
+VTX_SIZE = 16
+
+GFX_RE = re.compile(r'\s*(gs\w+)\(')
+VTX_LINE_RE = re.compile(r'\s*\{\{\{')
+
+def count_model_output(path):
+    counts = {}
+    dl_bytes = 0
+    vtx_count = 0
+    with open(path, 'r') as f:
+        for line in f:
+            match = GFX_RE.match(line)
+            if match:
+                name = match.group(1)
+                counts[name] = counts.get(name, 0) + 1
+                dl_bytes += GFX_WORDS.get(name, 1) * GFX_WORD_SIZE
+            elif VTX_LINE_RE.match(line):
+                vtx_count += 1
+
+    return {
+        'vertex_loads': counts.get('gsSPVertex', 0),
+        'triangle_commands': counts.get('gsSP1Triangle', 0) + counts.get('gsSP2Triangles', 0) + counts.get('gsSP3Triangles', 0),
+        'snake_commands': counts.get('gsSPTriSnake', 0) + counts.get('gsSPContinueSnake', 0),
+        'commands': sum(counts.values()),
+        'dl_bytes': dl_bytes,
+        'vtx_bytes': vtx_count * VTX_SIZE,
+    }
+
+# Rough RSP time of F3DEX3 commands in cycles, tune them with --costs.
+# Every command pays its entry, or 'default' per 64-bit word, vertices and triangles pay on top of the command drawing them.
+RSP_COSTS = {
+    'default': 10,
+    'vertex': 18,
+    'triangle': 60,
+    'gsSPVertex': 40,
+    'gsSPCullDisplayList': 30,
+    'gsSPDisplayList': 30,
+    'gsSPBranchList': 30,
+}
+
+def _snake_triangles(args):
+    # Every vertex after the first triangle adds one triangle, unused slots are -1
+    return sum(1 for vtx in args[::2] if vtx.split('|')[-1].strip() != '-1')
+
+def _list_stats():
+    return { 'commands': {}, 'dl_bytes': 0, 'vtx_dma_bytes': 0, 'vertices': 0, 'triangles': 0, 'rsp_cost': 0 }
+
+def _add_command(stats, name, line, costs):
+    counts = stats['commands']
+    counts[name] = counts.get(name, 0) + 1
+    words = GFX_WORDS.get(name, 1)
+    stats['dl_bytes'] += words * GFX_WORD_SIZE
+    cost = costs.get(name, costs['default'] * words)
+
+    if name in ( 'gsSPVertex', 'gsSP1Triangle', 'gsSP2Triangles', 'gsSP3Triangles', 'gsSPTriSnake', 'gsSPContinueSnake' ):
+        args = [ arg.strip() for arg in line[line.index('(') + 1:line.rindex(')')].split(',') ]
+        if 'gsSPVertex' == name:
+            vertices = _int_expr(args[1])
+            stats['vertices'] += vertices
+            stats['vtx_dma_bytes'] += vertices * VTX_SIZE
+            cost += vertices * costs['vertex']
+        else:
+            if 'gsSPTriSnake' == name:
+                tris = 1 + _snake_triangles(args[3:])
+            elif 'gsSPContinueSnake' == name:
+                tris = _snake_triangles(args)
+            else:
+                tris = { 'gsSP1Triangle': 1, 'gsSP2Triangles': 2, 'gsSP3Triangles': 3 }[name]
+            stats['triangles'] += tris
+            cost += tris * costs['triangle']
+
+    stats['rsp_cost'] += cost
+
+def _merge_stats(total, stats):
+    for name, count in stats['commands'].items():
+        total['commands'][name] = total['commands'].get(name, 0) + count
+    for metric, value in stats.items():
+        if 'commands' != metric:
+            total[metric] = total.get(metric, 0) + value
+
+def analyze_model_file(path, costs):
+    # Per Gfx list command counts, display list and vertex DMA bytes and estimated RSP cost of one model file
+    lists = {}
+    vtx_count = 0
+    stats = None
+    with open(path, 'r') as f:
+        for line in f:
+            match = GFX_RE.match(line)
+            if match:
+                if stats is not None:
+                    _add_command(stats, match.group(1), line, costs)
+                continue
+            if VTX_LINE_RE.match(line):
+                vtx_count += 1
+                continue
+            match = LIST_RE.match(line)
+            if match:
+                stats = lists.setdefault(match.group(2), _list_stats()) if 'Gfx' == match.group(1) else None
+
+    totals = _list_stats()
+    for list_stats in lists.values():
+        _merge_stats(totals, list_stats)
+    totals['vtx_bytes'] = vtx_count * VTX_SIZE
+    return { 'lists': lists, 'totals': totals }
+
+def model_level(model_path):
+    parts = os.path.abspath(model_path).split(os.sep)
+    if 'levels' in parts[:-2]:
+        return parts[parts.index('levels') + 1]
+    return os.path.dirname(model_path)
+
+def run_report(model_paths, suffix, costs):
+    models = {}
+    levels = {}
+    for model_path in model_paths:
+        output_path = model_path[:-len('.inc.c')] + suffix + '.inc.c'
+        if not os.path.exists(output_path):
+            continue
+
+        report = { 'original': analyze_model_file(model_path, costs), 'optimized': analyze_model_file(output_path, costs) }
+        models[model_path] = report
+        level = levels.setdefault(model_level(model_path), { 'original': _list_stats(), 'optimized': _list_stats() })
+        for kind in level:
+            _merge_stats(level[kind], report[kind]['totals'])
+
+    return { 'costs': costs, 'levels': levels, 'models': models }
+
+REPORT_METRICS = [ 'dl_bytes', 'vtx_dma_bytes', 'vtx_bytes', 'triangles', 'rsp_cost' ]
+
+def print_report(results, lists):
+    def line(key, original, optimized, metrics=REPORT_METRICS):
+        deltas = []
+        for metric in metrics:
+            old = original[metric]
+            new = optimized[metric]
+            change = f"{(new - old) / old * 100:+.1f}%" if old else 'n/a'
+            deltas.append(f"{metric} {old} -> {new} ({change})")
+        return f"{key}  " + '  '.join(deltas)
+
+    for model_path, report in results['models'].items():
+        if not lists:
+            continue
+        for name, optimized in report['optimized']['lists'].items():
+            original = report['original']['lists'].get(name)
+            if original is not None:
+                # Lists do not own Vtx arrays, only whole files have vtx_bytes
+                print(line(f"{model_path}:{name}", original, optimized, [ metric for metric in REPORT_METRICS if 'vtx_bytes' != metric ]))
+
+    total = { 'original': _list_stats(), 'optimized': _list_stats() }
+    for level, report in results['levels'].items():
+        print(line(level, report['original'], report['optimized']))
+        for kind in total:
+            _merge_stats(total[kind], report[kind])
+    if results['levels']:
+        print(line('total', total['original'], total['optimized']))
+
+LIST_RE = re.compile(r'(?:static\s+)?(?:const\s+)?(Gfx|Vtx)\s+(\w+)\s*\[')
+INT_TERM_RE = re.compile(r'[+-]?\s*\d+')
+
+def _int_expr(expr):
+    # Sums like '12 + 3' or '40 - 3' that the optimizer writes in gsSPVertex arguments
+    return sum(int(term.replace(' ', '')) for term in INT_TERM_RE.findall(expr))
+
+VTX_VALUES_RE = re.compile(r'-?(?:0x[0-9a-fA-F]+|\d+)')
+
+def _vtx_source(arg):
+    # 'name + 12 + 3' as written by the optimizer, None for anything the replay cannot resolve
+    name, *terms = [ term.strip() for term in arg.split('+') ]
+    try:
+        return name, sum(int(term, 0) for term in terms)
+    except ValueError:
+        return None
+
+def load_model_lists(path):
+    # Vertex values of every Vtx array and command lines of every Gfx list in a model file
+    vertices = {}
+    lists = {}
+    current = None
+    with open(path, 'r') as f:
+        for line in f:
+            match = LIST_RE.match(line)
+            if match:
+                current = vertices.setdefault(match.group(2), []) if 'Vtx' == match.group(1) else lists.setdefault(match.group(2), [])
+                continue
+            if current is None:
+                continue
+            if VTX_LINE_RE.match(line):
+                current.append(tuple(int(value, 0) for value in VTX_VALUES_RE.findall(line)))
+            elif GFX_RE.match(line):
+                current.append(line.strip())
+    return vertices, lists
+
+def _replay_list(vertices, lists, name, buffer, triangles):
+    # Draws one list on the vertex buffer like the RSP would, lists it calls are drawn in place.
+    # Returns False if a vertex source could not be resolved.
+    def draw(*tri):
+        tri = tuple(buffer[idx] for idx in tri)
+        if None in tri:
+            # Index of a slot nothing was loaded to, never equal to a drawn triangle
+            triangles.add(tri)
+            return
+        if len(set(tri)) < 3:
+            # Draws nothing, the optimizer drops these
+            return
+        # Rotation keeps the winding, only the starting vertex is normalized
+        first = min(range(3), key=lambda i: tri[i])
+        triangles.add(tri[first:] + tri[:first])
+
+    snake = None
+    def feed(pairs):
+        nonlocal snake
+        for vtx, turn in pairs:
+            if snake is None:
+                return
+            last = 'G_SNAKE_LAST' in vtx
+            vtx = int(vtx.split('|')[-1])
+            if vtx < 0:
+                return
+            a, b, c = snake
+            if 'G_SNAKE_LEFT' == turn:
+                c = a
+            else:
+                b = a
+            snake = [ vtx, b, c ]
+            draw(*snake)
+            if last:
+                snake = None
+
+    for line in lists[name]:
+        command = GFX_RE.match(line).group(1)
+        args = [ arg.strip() for arg in line[line.index('(') + 1:line.rindex(')')].split(',') ]
+        if 'gsSPVertex' == command:
+            source = _vtx_source(args[0])
+            if source is None or source[0] not in vertices:
+                return False
+            array, offset = source
+            amount = _int_expr(args[1])
+            dst = _int_expr(args[2])
+            if offset + amount > len(vertices[array]):
+                return False
+            buffer[dst:dst + amount] = vertices[array][offset:offset + amount]
+        elif 'gsSP1Triangle' == command:
+            draw(*map(int, args[0:3]))
+        elif 'gsSP2Triangles' == command:
+            draw(*map(int, args[0:3]))
+            draw(*map(int, args[4:7]))
+        elif 'gsSP3Triangles' == command:
+            for i in range(0, 9, 3):
+                draw(*map(int, args[i:i + 3]))
+        elif 'gsSPTriSnake' == command:
+            i1, i2, i3 = ( int(arg.split('|')[-1]) for arg in args[:3] )
+            snake = [ i3, i1, i2 ]
+            draw(*snake)
+            if 'G_SNAKE_LAST' in args[2]:
+                snake = None
+            feed(zip(args[3::2], args[4::2]))
+        elif 'gsSPContinueSnake' == command:
+            feed(zip(args[0::2], args[1::2]))
+        elif 'gsSPDisplayList' == command and args[0] in lists:
+            if not _replay_list(vertices, lists, args[0], buffer, triangles):
+                return False
+    return True
+
+def replay_model_file(path):
+    # Set of triangles drawn by every Gfx list of a model file as vertex values, None for lists that cannot be replayed
+    vertices, lists = load_model_lists(path)
+    result = {}
+    for name in lists:
+        triangles = set()
+        result[name] = triangles if _replay_list(vertices, lists, name, [ None ] * 64, triangles) else None
+    return result
+
+# Settings every model is verified with unless --set is given, the ones that move vertices across chunks and passes
+VERIFY_SETTINGS = [
+    { 'SHARE_VTX_BUFFER': True },
+    { 'SHARE_VTX_BUFFER': True, 'VTX_LOADER': 'partition' },
+    { 'SHARE_VTX_BUFFER': True, 'SPLIT_COUNT': 4 },
+]
+
+def run_verify(cases):
+    # Optimizes each model on a copy and compares the triangles every original list draws with the optimized one
+    results = {}
+    for model_path, settings in cases:
+        # Models without a header are indexized only, like the optimizer does with them
+        header_path = model_path[:-len('.c')] + '.h'
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp_model_path = os.path.join(tmp, os.path.basename(model_path))
+            shutil.copy(model_path, tmp_model_path)
+            args = [ sys.executable, '-c', MODEL_RUNNER, os.path.dirname(MESH_OPTIMIZER_PATH), json.dumps(settings), tmp_model_path ]
+            if os.path.exists(header_path):
+                args.append(os.path.join(tmp, os.path.basename(header_path)))
+                shutil.copy(header_path, args[-1])
+            proc = subprocess.run(args, capture_output=True, text=True)
+            key = f"{model_path}:{json.dumps(settings, sort_keys=True)}"
+            if proc.returncode:
+                results[key] = { 'error': proc.stderr.strip().splitlines()[-1] }
+                continue
+
+            original = replay_model_file(model_path)
+            optimized = replay_model_file(tmp_model_path[:-len('.inc.c')] + 'opt.inc.c')
+
+        result = { 'lists': 0, 'skipped': [], 'mismatches': {} }
+        for name, triangles in original.items():
+            if triangles is None or optimized.get(name) is None:
+                result['skipped'].append(name)
+                continue
+            result['lists'] += 1
+            drawn = optimized[name]
+            if triangles != drawn:
+                result['mismatches'][name] = { 'missing': len(triangles - drawn), 'wrong': len(drawn - triangles) }
+        results[key] = result
+    return results
+
+def print_verify(results):
+    for key, result in results.items():
+        if 'error' in result:
+            print(f"{key}  error: {result['error']}")
+            continue
+        print(f"{key}  lists {result['lists']} skipped {len(result['skipped'])} mismatches {len(result['mismatches'])}")
+        for name, mismatch in result['mismatches'].items():
+            print(f"  {name}: {mismatch['missing']} missing, {mismatch['wrong']} wrong triangles")
+
+# Runs one entry point on a copy of the model in a fresh interpreter so wall time and peak memory belong to it alone
+MODEL_RUNNER = '''
+import json, resource, sys, time
+sys.path.insert(0, sys.argv[1])
+start = time.perf_counter()
+import mesh_optimizer
+for name, value in json.loads(sys.argv[2]).items():
+    setattr(mesh_optimizer, name, value)
+mesh_optimizer.optimize_file(sys.argv[3], sys.argv[4] if len(sys.argv) > 4 else None)
+elapsed = time.perf_counter() - start
+# ru_maxrss is in kilobytes on Linux and in bytes on macOS
+maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+sys.stderr.write(json.dumps({ 'time': elapsed, 'peak_memory_kb': maxrss // 1024 if sys.platform == 'darwin' else maxrss }))
+'''
+
+def collect_models(patterns):
+    model_paths = []
+    for pattern in patterns:
+        model_paths.extend(sorted(glob.glob(pattern)))
+    return model_paths
+
+def parse_settings(settings):
+    # NAME=VALUE pairs overriding mesh_optimizer globals, values are json so booleans and numbers work
+    result = {}
+    for setting in settings or []:
+        name, value = setting.split('=', 1)
+        try:
+            result[name] = json.loads(value)
+        except json.JSONDecodeError:
+            result[name] = value
+    return result
+
+def run_model(model_path, mode, runs, settings):
+    header_path = model_path[:-len('.c')] + '.h'
+    if mode == 'optimize' and not os.path.exists(header_path):
+        return None
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp_model_path = os.path.join(tmp, os.path.basename(model_path))
+        shutil.copy(model_path, tmp_model_path)
+        args = [ tmp_model_path ]
+        if mode == 'optimize':
+            tmp_header_path = os.path.join(tmp, os.path.basename(header_path))
+            shutil.copy(header_path, tmp_header_path)
+            args.append(tmp_header_path)
+
+        runs_stats = []
+        for _ in range(runs):
+            proc = subprocess.run([ sys.executable, '-c', MODEL_RUNNER, os.path.dirname(MESH_OPTIMIZER_PATH), json.dumps(settings) ] + args, capture_output=True, text=True)
+            if proc.returncode:
+                return { 'error': proc.stderr.strip().splitlines()[-1] }
+            runs_stats.append(json.loads(proc.stderr.strip().splitlines()[-1]))
+
+        # Output of the optimizer is deterministic so it is enough to inspect the last one
+        tmp_output_path = os.path.join(tmp, os.path.basename(model_path)[:-len('.inc.c')] + 'opt.inc.c')
+        result = count_model_output(tmp_output_path)
+        result['time'] = min(stats['time'] for stats in runs_stats)
+        result['peak_memory_kb'] = max(stats['peak_memory_kb'] for stats in runs_stats)
+        return result
+
+def run_models(model_paths, modes, runs, settings):
+    results = {}
+    for model_path in model_paths:
+        for mode in modes:
+            result = run_model(model_path, mode, runs, settings)
+            if result is not None:
+                results[f"{model_path}:{mode}"] = result
+                print_model(f"{model_path}:{mode}", result)
+    return results
+
+# Metrics where growing is a regression and how much growth is tolerated by default
+REGRESSION_METRICS = {
+    'time': 0.2,
+    'peak_memory_kb': 0.2,
+    'vertex_loads': 0.0,
+    'vtx_bytes': 0.0,
+    'commands': 0.0,
+    'dl_bytes': 0.0,
+}
+
+def compare_models(results, baseline, time_tolerance):
+    tolerances = dict(REGRESSION_METRICS)
+    tolerances['time'] = time_tolerance
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline or 'error' in result or 'error' in baseline[key]:
+            continue
+        for metric, tolerance in tolerances.items():
+            old = baseline[key][metric]
+            new = result[metric]
+            if new > old * (1 + tolerance):
+                regressions.append(f"{key}: {metric} {old} -> {new}")
+
+    return regressions
+
+def print_model(key, result):
+    if 'error' in result:
+        print(f"{key}  error: {result['error']}")
+        return
+
+    print(f"{key}  {result['time']:7.2f}s {result['peak_memory_kb'] // 1024:5}MB  "
+          f"vtx {result['vertex_loads']:5} tri {result['triangle_commands']:6} snake {result['snake_commands']:5}  "
+          f"dl {result['dl_bytes']:8}B vtx {result['vtx_bytes']:8}B")
+
+def print_startup(results):
+    for name, result in results.items():
+        heavy = ', '.join(result['heavy_imports']) or 'none'
+        print(f"{name.ljust(16)} min {result['min'] * 1000:7.1f}ms  median {result['median'] * 1000:7.1f}ms  heavy imports: {heavy}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks for mesh_optimizer.py')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    startup_parser = subparsers.add_parser('startup', help='time a full run of each entry point on a tiny model')
+    startup_parser.add_argument('--runs', type=int, default=10)
+    startup_parser.add_argument('--json', metavar='FILE', help='also write results to FILE')
+
+    parse_parser = subparsers.add_parser('parse', help='time load_model on the given models')
+    parse_parser.add_argument('models', nargs='*', help='models to load, default is PARSE_MODELS')
+    parse_parser.add_argument('--runs', type=int, default=5)
+    parse_parser.add_argument('--check', action='store_true', help='also check that every vertex parses and the model is written back unchanged')
+    parse_parser.add_argument('--json', metavar='FILE', help='also write results to FILE')
+
+    models_parser = subparsers.add_parser('models', help='run the optimizer over level models and compare with a baseline')
+    models_parser.add_argument('--models', metavar='GLOB', action='append', help='models to run, default is every level custom model')
+    models_parser.add_argument('--mode', choices=['optimize', 'indexize'], action='append', help='entry points to run, default is both')
+    models_parser.add_argument('--runs', type=int, default=1, help='best of N wall time')
+    models_parser.add_argument('--set', metavar='NAME=VALUE', action='append', help='override a mesh_optimizer global, e.g. TRI_REORDER=true')
+    models_parser.add_argument('--baseline', metavar='FILE', help='flag regressions against results stored in FILE')
+    models_parser.add_argument('--time-tolerance', type=float, default=REGRESSION_METRICS['time'], help='allowed relative slowdown before it is flagged')
+    models_parser.add_argument('--json', metavar='FILE', help='also write results to FILE, usable as a baseline later')
+
+    report_parser = subparsers.add_parser('report', help='compare display list size and estimated RSP cost of original and optimized models')
+    report_parser.add_argument('models', nargs='*', help='original models, default is every level model')
+    report_parser.add_argument('--suffix', default='opt', help='suffix of the optimized models, e.g. opt_p for split ones')
+    report_parser.add_argument('--costs', metavar='FILE', help='json overriding entries of the RSP cost table')
+    report_parser.add_argument('--lists', action='store_true', help='also print every display list')
+    report_parser.add_argument('--json', metavar='FILE', help='also write results to FILE')
+
+    verify_parser = subparsers.add_parser('verify', help='check that optimized models draw the same triangles as the originals')
+    verify_parser.add_argument('models', nargs='*', help='models to optimize, default is every level model')
+    verify_parser.add_argument('--set', metavar='NAME=VALUE', action='append', help='verify with these mesh_optimizer globals instead of VERIFY_SETTINGS')
+    verify_parser.add_argument('--json', metavar='FILE', help='also write results to FILE')
+
+    args = parser.parse_args()
+
+    if args.command == 'startup':
+        results = run_startup(args.runs)
+        print_startup(results)
+    elif args.command == 'parse':
+        repo_path = os.path.dirname(os.path.dirname(MESH_OPTIMIZER_PATH))
+        results = run_parse(args.models or [ os.path.join(repo_path, model_path) for model_path in PARSE_MODELS ], args.runs, args.check)
+        print_parse(results)
+    elif args.command == 'models':
+        repo_path = os.path.dirname(os.path.dirname(MESH_OPTIMIZER_PATH))
+        model_paths = collect_models(args.models or [ os.path.join(repo_path, 'levels', '*', 'custom_c', 'custom.model.inc.c') ])
+        results = run_models(model_paths, args.mode or [ 'optimize', 'indexize' ], args.runs, parse_settings(args.set))
+
+        regressions = []
+        if args.baseline:
+            with open(args.baseline, 'r') as f:
+                regressions = compare_models(results, json.load(f), args.time_tolerance)
+            for regression in regressions:
+                print(f"REGRESSION {regression}")
+            print(f"{len(regressions)} regressions against {args.baseline}")
+
+    elif args.command == 'report':
+        costs = dict(RSP_COSTS)
+        if args.costs:
+            with open(args.costs, 'r') as f:
+                costs.update(json.load(f))
+        repo_path = os.path.dirname(os.path.dirname(MESH_OPTIMIZER_PATH))
+        model_paths = collect_models(args.models or [ os.path.join(repo_path, 'levels', '*', 'custom_c', '*.model.inc.c') ])
+        results = run_report(model_paths, args.suffix, costs)
+        print_report(results, args.lists)
+
+    elif args.command == 'verify':
+        repo_path = os.path.dirname(os.path.dirname(MESH_OPTIMIZER_PATH))
+        model_paths = collect_models(args.models or [ os.path.join(repo_path, 'levels', '*', 'custom_c', '*.model.inc.c') ])
+        settings_list = [ parse_settings(args.set) ] if args.set else VERIFY_SETTINGS
+        results = run_verify([ (model_path, settings) for model_path in model_paths for settings in settings_list ])
+        print_verify(results)
+        failures = [ key for key, result in results.items() if 'error' in result or result['mismatches'] ]
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1)
+
+    if args.command == 'parse' and not all(result.get('round_trip', True) for result in results.values()):
+        sys.exit(1)
+    if args.command == 'models' and regressions:
+        sys.exit(1)
+    if args.command == 'verify' and failures:
+        sys.exit(1)